@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Headless capture series runner for scripted and overnight acquisition. It runs a
+series through the same AcquisitionEngine, FrameWriter and SeriesJournal as the GUI,
+but loads neither Qt nor matplotlib, so it starts in a fraction of the GUI's time
+and memory. Progress and throughput are printed for every readout:
+
+    python AcquireCLI.py --serial 0809080002 --series "5 1200 HeNe_darks_1200ms" \\
+        --output D:\\images --codec shuffle-zlib:1 --roi 0 1024 256 768 --binning 1x2
+
+    python AcquireCLI.py --simulate --series-file overnight.txt --output images
+
+--series-file - reads the series from standard input. Ctrl-C stops the series; its
+journal stays open, so --resume <journal> continues it later. Exit status:
+
+    0   series finished and every frame written
+    1   series interrupted by an error or a dead acquisition thread, or frames dropped or not written
+    2   bad arguments, series text or ROI
+    3   camera could not be opened
+    130 stopped with Ctrl-C
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+from AcquisitionEngine import AcquisitionEngine
+from CameraConnection import check_roi, open_camera
+from Codecs import CODECCHOICES
+from CubeFile import CubeSink
+from FrameBuffer import FrameRingBuffer
+from FrameTimings import peak_rss_mb
+from FrameWriter import FrameWriter, FileSink, SessionManifest
+from SeriesJournal import SeriesJournal
+from SeriesPlan import SeriesError, compile_series
+
+EXITOK = 0
+EXITFAILED = 1
+EXITUSAGE = 2
+EXITCAMERA = 3
+EXITINTERRUPTED = 130
+
+
+def parse_binning(text):
+    try:
+        hbin, vbin = (int(b) for b in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected horizontal x vertical binning, e.g. 1x8, not '{text}'")
+    return hbin, vbin
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Run a capture series without the GUI.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--series', help="series text; separate lines with newlines or ';'")
+    source.add_argument('--series-file', help="file with the series text, '-' for standard input")
+    source.add_argument('--resume', help="journal of an interrupted series to continue")
+    parser.add_argument('--output', default='images', help="folder for the frames and the journal")
+    parser.add_argument('--codec', default='npz', choices=CODECCHOICES + ['cube'],
+                        help="frame codec from Codecs.py, or 'cube' for one .cube per series")
+    parser.add_argument('--roi', nargs=4, type=int, metavar=('X0', 'X1', 'Y0', 'Y1'),
+                        help="sensor region in pixels, ends exclusive")
+    parser.add_argument('--binning', type=parse_binning, default=(1, 1), help="e.g. 1x8")
+    parser.add_argument('--serial', help="camera serial number; the first camera found if omitted")
+    parser.add_argument('--dll', help="path of Picam.dll")
+    parser.add_argument('--simulate', action='store_true', help="use the simulated camera")
+    parser.add_argument('--batched', action='store_true', help="read every frame waiting in the camera buffer at once")
+    parser.add_argument('--buffer-frames', type=int, default=64,
+                        help="frames the camera buffer holds, at most --ring-frames")
+    parser.add_argument('--ring-frames', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--queue', type=int, default=32)
+    parser.add_argument('--wait-stable', action='store_true',
+                        help="wait for a stable sensor temperature before the series starts")
+    parser.add_argument('--dwell', type=float, default=30.0,
+                        help="seconds the sensor must hold its set point to count as stable")
+    return parser
+
+
+def read_series(args):
+    if args.series is not None:
+        return args.series.replace(';', '\n')
+    if args.series_file == '-':
+        return sys.stdin.read()
+    with open(args.series_file) as f:
+        return f.read()
+
+
+class Progress(object):
+    # Prints the engine's status with the series progress and the writer's throughput
+    def __init__(self, journal, writer, out = sys.stdout):
+        self.journal = journal
+        self.writer = writer
+        self.out = out
+        self.start = time.perf_counter()
+        # When the first frame was read, so waiting for the sensor doesn't count against throughput
+        self.first_frame = None
+        self.errors = []
+        self.outcome = None
+        self.done = threading.Event()
+
+    def __call__(self, text):
+        elapsed = time.perf_counter() - self.start
+        if text.startswith('Series: step') and ', frame ' in text:
+            if self.first_frame is None:
+                self.first_frame = time.perf_counter()
+            saved, total = self.journal.progress()
+            stats = self.writer.stats()
+            text = (f"{text[len('Series: '):]} | saved {saved}/{total}, "
+                    f"{stats['frames_per_s']:.1f} frames/s, {stats['mb_per_s']:.1f} MB/s, "
+                    f"queue {stats['queue_depth']}/{stats['max_queue']}")
+        elif text.startswith('Error'):
+            self.errors.append(text)
+        print(f"[{elapsed:8.1f} s] {text}", file=self.out, flush=True)
+        if text in ('Series finished', 'Series interrupted'):
+            self.outcome = text
+            self.done.set()
+
+
+def wait_for_series(progress, thread):
+    # False if the engine thread ended without finishing or interrupting the series
+    while not progress.done.wait(0.5):
+        if not thread.is_alive():
+            return progress.done.is_set()
+    return True
+
+
+def main(argv = None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.buffer_frames > args.ring_frames:
+        parser.error(f"--buffer-frames {args.buffer_frames} is more than the {args.ring_frames} --ring-frames")
+    start = time.perf_counter()
+    os.makedirs(args.output, exist_ok=True)
+    if args.resume:
+        journal = SeriesJournal.load(args.resume)
+    else:
+        try:
+            plan = compile_series(read_series(args))
+        except SeriesError as e:
+            print(f"Series: {e}", file=sys.stderr)
+            return EXITUSAGE
+        except OSError as e:
+            print(f"Cannot read the series: {e}", file=sys.stderr)
+            return EXITUSAGE
+        print(f"Series: {plan.summary()}")
+
+    try:
+        cam = open_camera(args.serial, args.dll, args.simulate)
+    except Exception as e:
+        print(f"Cannot open the camera: {e}", file=sys.stderr)
+        return EXITCAMERA
+    roi = None
+    if args.roi is not None or args.binning != (1, 1):
+        width, height = cam.get_detector_size()
+        roi = tuple(args.roi or (0, width, 0, height)) + args.binning
+        try:
+            check_roi(roi, (width, height))
+        except ValueError as e:
+            cam.close()
+            print(f"ROI: {e}", file=sys.stderr)
+            return EXITUSAGE
+
+    manifest = SessionManifest(args.output)
+    if args.codec == 'cube':
+        writer = FrameWriter(CubeSink(args.output), num_workers=1, max_queue=args.queue, manifest=manifest)
+    else:
+        writer = FrameWriter(FileSink(args.output, args.codec), num_workers=args.workers,
+                             max_queue=args.queue, manifest=manifest)
+    if not args.resume:
+        journal = SeriesJournal.create(args.output, plan)
+    progress = Progress(journal, writer)
+    frames = FrameRingBuffer(args.ring_frames)
+    engine = AcquisitionEngine(cam, writer, frames, status=progress)
+    engine.batched = args.batched
+    engine.buffer_frames = args.buffer_frames
+    engine.wait_stable = args.wait_stable
+    engine.temperature.dwell = args.dwell
+    thread = threading.Thread(target=engine.run, name="Acquisition")
+    print(f"Journal: {journal.path}")
+    print(f"Ready in {time.perf_counter() - start:.2f} s")
+    progress.start = time.perf_counter()
+    thread.start()
+    if roi is not None:
+        engine.set_roi(*roi)
+    engine.series(journal)
+
+    interrupted = False
+    try:
+        ended = wait_for_series(progress, thread)
+    except KeyboardInterrupt:
+        interrupted = True
+        print("Stopping the series; the frames already captured are still saved", file=sys.stderr)
+        engine.pause()
+        ended = wait_for_series(progress, thread)
+    if not ended:
+        print("The acquisition thread ended unexpectedly", file=sys.stderr)
+        progress.outcome = "Series stopped"
+    engine.stop()
+    thread.join()
+    # Every frame still in the writer queue is saved before exiting
+    writer.close()
+    manifest.close()
+
+    end = time.perf_counter()
+    stats = writer.stats()
+    saved, total = journal.progress()
+    memory = peak_rss_mb()
+    capturing = end - (progress.first_frame or end)
+    print(f"{progress.outcome}: {saved}/{total} frames of the series, {stats['written']} written "
+          f"in {end - progress.start:.1f} s"
+          + (f" ({stats['written'] / capturing:.1f} frames/s while capturing)" if capturing > 0 else "")
+          + f", dropped {stats['dropped']}, failed {stats['failed']}, ring buffer overruns {frames.overruns}"
+          + (f", peak memory {memory:.0f} MB" if memory is not None else ""))
+    if interrupted:
+        return EXITINTERRUPTED
+    if progress.outcome != 'Series finished' or stats['dropped'] or stats['failed'] or frames.overruns \
+            or progress.errors:
+        return EXITFAILED
+    return EXITOK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+End-to-end benchmark of the acquisition -> save -> display path. Each run drives the
+AcquisitionEngine against the simulated camera, saves through a FrameWriter and
+renders through the DisplayThrottle into either the fast QImage view or a matplotlib
+canvas, all headless on the offscreen Qt platform. Runs sweep exposure times, frame
+counts, codecs, display modes and single or batched readout; each one runs in its own process so its peak
+memory is measured on its own. The results are printed (or written) as JSON:
+
+    python AcquisitionBenchmark.py --exposures 1 10 100 --frames 50 \\
+        --codecs npz raw cube --displays fast matplotlib --readouts single batched \\
+        --output bench.json
+
+For every run the JSON holds the sustained frame rate, the dropped and overrun frame
+counts, the peak RSS, and p50/p99/mean latencies in ms of each stage: waiting for a
+frame, reading it (one frame or one batch), saving it (from submit to written), rendering it and the display
+latency from readout to the end of rendering.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from FrameTimings import peak_rss_mb
+
+
+def latency_summary(samples):
+    if not samples:
+        return None
+    ms = np.asarray(samples) * 1000
+    return {
+        'count': len(ms),
+        'mean': float(ms.mean()),
+        'p50': float(np.percentile(ms, 50)),
+        'p99': float(np.percentile(ms, 99)),
+    }
+
+
+# Records how long each call of a camera method takes
+class TimedCamera(object):
+    def __init__(self, cam, samples):
+        self._cam = cam
+        self._samples = samples
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cam, name)
+        if name not in ('wait_for_frame', 'read_oldest_image', 'read_multiple_images'):
+            return attribute
+        key = 'wait_for_frame' if name == 'wait_for_frame' else 'read'
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = attribute(*args, **kwargs)
+            self._samples[key].append(time.perf_counter() - start)
+            return result
+        return timed
+
+
+def make_display(mode):
+    from DisplayScaling import DisplayScaling
+    scaling = DisplayScaling()
+    if mode == 'fast':
+        from FastImageView import FastImageView
+        view = FastImageView()
+        view.resize(700, 700)
+        view.show()
+        return view, lambda img: (view.set_image(img, *scaling.limits(img)), view.repaint())
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+    figure = Figure()
+    ax = figure.add_subplot(111)
+    image_handle = ax.imshow(np.zeros((1024, 1024)), interpolation='nearest', cmap='Blues', vmin=0)
+    canvas = FigureCanvas(figure)
+    canvas.resize(700, 700)
+    canvas.show()
+
+    def render(img):
+        image_handle.set_data(img)
+        image_handle.set_clim(*scaling.limits(img))
+        canvas.draw()
+    return canvas, render
+
+
+def run_once(config):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtCore, QtWidgets
+    from AcquisitionEngine import AcquisitionEngine
+    from CubeFile import CubeSink
+    from DisplayThrottle import DisplayThrottle
+    from FrameBuffer import FrameRingBuffer
+    from FrameWriter import FrameWriter, FileSink
+    from SeriesJournal import SeriesJournal
+    from SimulatedCamera import SimulatedPicamCamera
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    samples = {'wait_for_frame': [], 'read': [], 'save': [], 'render': [],
+               'display_latency': []}
+    folder = tempfile.mkdtemp(prefix='shimco_bench_')
+
+    sim = SimulatedPicamCamera(readout_time=config['readout_ms'] / 1000,
+                               buffer_frames=config['buffer_frames'])
+    cam = TimedCamera(sim, samples)
+    if config['codec'] == 'cube':
+        writer = FrameWriter(CubeSink(folder), num_workers=1, max_queue=config['queue'])
+    else:
+        writer = FrameWriter(FileSink(folder, config['codec']), num_workers=config['workers'],
+                             max_queue=config['queue'])
+    frames = FrameRingBuffer(config['ring_frames'])
+    engine = AcquisitionEngine(cam, writer, frames, status=lambda text: None)
+    engine.batched = config['readout'] == 'batched'
+    engine.buffer_frames = config['buffer_frames']
+
+    widget, render = make_display(config['display'])
+
+    # Frames travel through the throttle together with the time they were read
+    def offer(img):
+        throttle.offer((img, time.perf_counter()))
+
+    def timed_render(item):
+        img, captured_at = item
+        start = time.perf_counter()
+        render(img)
+        end = time.perf_counter()
+        samples['render'].append(end - start)
+        samples['display_latency'].append(end - captured_at)
+
+    throttle = DisplayThrottle(timed_render, config['display_rate'])
+    engine.display = offer
+
+    # Time from submit to written for every frame
+    submit = writer.submit
+
+    def timed_submit(img, target, on_saved=None, **meta):
+        start = time.perf_counter()
+
+        def saved(file_path):
+            samples['save'].append(time.perf_counter() - start)
+            if on_saved is not None:
+                on_saved(file_path)
+        return submit(img, target, on_saved=saved, **meta)
+    writer.submit = timed_submit
+
+    journal = SeriesJournal.create(folder, [[config['frames'], config['exposure_ms'], 'bench']])
+    done = threading.Event()
+    engine.status = lambda text: done.set() if text in ('Series finished', 'Series interrupted') else None
+    thread = threading.Thread(target=engine.run)
+    start = time.perf_counter()
+    thread.start()
+    engine.series(journal)
+    while not done.is_set():
+        app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+    writer.close()
+    elapsed = time.perf_counter() - start
+    engine.stop()
+    thread.join()
+    app.processEvents()
+    shutil.rmtree(folder, ignore_errors=True)
+
+    stats = writer.stats()
+    return {
+        'config': config,
+        'elapsed_s': elapsed,
+        'sustained_fps': stats['written'] / elapsed,
+        'written': stats['written'],
+        'dropped': stats['dropped'],
+        'camera_overruns': sim.overruns,
+        'ring_overruns': frames.overruns,
+        'display_skipped': throttle.skipped,
+        'frames_per_read': engine.batched_frames / engine.batches if engine.batches else 1.0,
+        'peak_rss_mb': peak_rss_mb(),
+        'latency_ms': {stage: latency_summary(values) for stage, values in samples.items()},
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmark acquisition, saving and display.")
+    parser.add_argument('--exposures', nargs='+', type=float, default=[1, 10, 100], help="ms")
+    parser.add_argument('--frames', nargs='+', type=int, default=[50])
+    parser.add_argument('--codecs', nargs='+', default=['npz', 'raw', 'cube'],
+                        help="codec names from Codecs.py, or 'cube'")
+    parser.add_argument('--displays', nargs='+', default=['fast', 'matplotlib'])
+    parser.add_argument('--readouts', nargs='+', default=['single'], choices=['single', 'batched'])
+    parser.add_argument('--readout-ms', type=float, default=5.0)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--queue', type=int, default=32)
+    parser.add_argument('--ring-frames', type=int, default=64)
+    parser.add_argument('--buffer-frames', type=int, default=64)
+    parser.add_argument('--display-rate', type=float, default=20)
+    parser.add_argument('--output', help="write the JSON results to this file")
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        # A single configuration, in the child process started below
+        print(json.dumps(run_once(json.loads(args.run))))
+        return
+
+    results = []
+    for exposure, count, codec, display, readout in itertools.product(
+            args.exposures, args.frames, args.codecs, args.displays, args.readouts):
+        config = {
+            'exposure_ms': exposure, 'frames': count, 'codec': codec, 'display': display,
+            'readout': readout,
+            'readout_ms': args.readout_ms, 'workers': args.workers, 'queue': args.queue,
+            'ring_frames': args.ring_frames, 'buffer_frames': args.buffer_frames,
+            'display_rate': args.display_rate,
+        }
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', json.dumps(config)],
+                               capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        if child.returncode != 0:
+            results.append({'config': config, 'error': child.stderr.strip().splitlines()[-1:]})
+        else:
+            results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+        result = results[-1]
+        print(f"{exposure:>7g} ms {count:>5d} frames {codec:>22} {display:>10} {readout:>7}: "
+              + (f"{result['sustained_fps']:.1f} fps, dropped {result['dropped']}"
+                 if 'error' not in result else f"failed {result['error']}"),
+              file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
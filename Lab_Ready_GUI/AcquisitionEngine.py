@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Acquisition engine that owns the camera. All camera work (live capture, capture
+series, attribute changes) runs on the single thread that calls run(), driven by
+commands put on a queue by the GUI or a script: live, pause, series, target, set,
+readout, roi and stop. Frames go to the display callback and the frame writer; progress goes to
+the status callback. Nothing in here touches Qt, so the GUI runs the engine in a
+QThread and forwards the callbacks through signals, while scripts can run it
+directly.
+
+In batched readout mode every wait for a frame is followed by a single
+read_multiple_images() call that moves the frames waiting in the camera buffer
+into the ring buffer, instead of one read_oldest_image() call per frame; only the
+newest frame of each batch is displayed. A batch never holds more frames than the
+ring buffer has free slots for; the rest wait in the camera buffer for the next
+read. The size of the camera buffer is set through setup_acquisition() before the
+next acquisition starts, at most the capacity of the ring buffer.
+
+A series step [n, exposure, target, 'stack'] also stacks its frames with a
+FrameStacker and saves the stack next to the journal when the step ends;
+'stack-only' saves only the stack and none of the individual frames. Stacking and
+saving stacks run on a reduction thread, like saving frames runs on the writer's,
+so a step's reduction overlaps the exposures and delays of the steps after it; the
+series only finishes once both have caught up. Consecutive capture steps with the
+same exposure time share one running acquisition instead of stopping and
+re-arming the camera for every step; only the target and file routing change.
+Frames a step did not need stay in the camera buffer and go to the next step that
+shares its acquisition. The time that saves, estimated from the measured start and
+stop times, is reported when the series ends, like the surplus frames discarded
+when an acquisition stopped. A ['temperature', set point, tolerance] step sets
+the sensor set point and holds the series until the sensor is stable, however
+long that takes, while still handling commands.
+
+engine.temperature is a TemperatureMonitor that decides when the sensor is
+stable; it is fed by telemetry when there is any and otherwise by the waiting
+engine itself. A state change wakes a waiting engine right away. With wait_stable
+set, live capture and series also wait for a stable sensor before they start.
+
+With a CalibrationLibrary in engine.calibration, the master dark or bias matching
+the current exposure time and set point is subtracted from every frame before it
+is displayed; with calibrate_saved it is subtracted in place in the ring buffer,
+so the saved and stacked frames are calibrated too.
+
+A FrameStats in engine.stats is offered the newest frame of every readout, as it
+is saved, and computes its statistics at its own, throttled rate.
+"""
+
+import datetime
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from CalibrationLibrary import subtract
+from FrameStacker import FrameStacker
+from FrameTimings import StageTimer
+from SeriesPlan import step_kind
+from TemperatureMonitor import TemperatureMonitor
+
+# Stages timed for every readout (one frame, or one batch in batched mode) while
+# engine.timings is enabled
+STAGES = ('wait_for_frame', 'read', 'buffer', 'display', 'submit')
+# Seconds between status updates while waiting for a stable sensor, and the age after
+# which the engine reads the sensor itself because nothing else feeds the monitor
+TEMPERATUREPOLL = 1.0
+
+
+class AcquisitionEngine(object):
+    def __init__(self, cam, writer, frames, display = None, status = None):
+        self.cam = cam
+        self.writer = writer
+        self.frames = frames
+        self.display = display or (lambda img: None)
+        self.status = status or print
+        self.commands = queue.Queue()
+        # Serializes short driver calls made from other threads with the engine's own
+        self.camera_lock = threading.RLock()
+        self.attributes = {}
+        self.target = 'None'
+        self.state = 'idle'
+        self.timings = StageTimer(STAGES)
+        self.batched = False
+        # Camera buffer size in frames; None keeps the driver's setting
+        self.buffer_frames = None
+        self._configured_buffer = None
+        self.batches = 0
+        self.batched_frames = 0
+        # Sigma clip of stacked series steps, None to keep every sample
+        self.stack_clip = 3.0
+        # Runs stacking in order, off the acquisition thread
+        self._reducer = ThreadPoolExecutor(1, thread_name_prefix='Reduction')
+        # Seconds the last start_acquisition() and stop_acquisition() took
+        self.start_time = 0.0
+        self.stop_time = 0.0
+        # Re-arms skipped and seconds saved by keeping the acquisition running in the last series
+        self.rearms_skipped = 0
+        self.rearm_saved = 0.0
+        # Frames left unread in the camera buffer when the last series stopped its acquisitions
+        self.surplus = 0
+        self.calibration = None
+        self.calibrate_saved = False
+        # File of the master subtracted from the frames being saved, if any
+        self.calibrated = None
+        self.stats = None
+        # (hstart, hend, vstart, vend, hbin, vbin) read back from the camera
+        self.roi = None
+        self.temperature = TemperatureMonitor()
+        # Hold live capture and series until the sensor is stable at its set point
+        self.wait_stable = False
+
+    # Commands, safe to call from any thread
+    def live(self):
+        self.commands.put(('live',))
+
+    def pause(self):
+        self.commands.put(('pause',))
+
+    def series(self, journal):
+        self.commands.put(('series', journal))
+
+    def set_target(self, target):
+        self.commands.put(('target', target))
+
+    def set_attributes(self, **attributes):
+        # Keyword names use underscores for spaces, e.g. Exposure_Time=100
+        self.commands.put(('set', {name.replace('_', ' '): value for name, value in attributes.items()}))
+
+    def set_readout(self, batched = None, buffer_frames = None):
+        # A new buffer size takes effect when the next acquisition starts
+        settings = {'batched': batched, 'buffer_frames': buffer_frames}
+        self.commands.put(('readout', {name: value for name, value in settings.items() if value is not None}))
+
+    def set_roi(self, hstart, hend, vstart, vend, hbin = 1, vbin = 1):
+        # Applied right away in live capture, refused during a series
+        self.commands.put(('roi', dict(hstart=hstart, hend=hend, vstart=vstart, vend=vend,
+                                       hbin=hbin, vbin=vbin)))
+
+    def stop(self):
+        self.commands.put(('stop',))
+
+    def has_attribute(self, name):
+        with self.camera_lock:
+            return name in self.cam.get_all_attributes()
+
+    def get_attribute(self, name):
+        with self.camera_lock:
+            value = self.cam.get_attribute_value(name)
+        self.attributes[name] = value
+        return value
+
+    def run(self):
+        command = None
+        while True:
+            if command is None:
+                # Idle: block until the next command arrives
+                command = self.commands.get()
+            command = self._dispatch(command)
+            if command is not None and command[0] == 'stop':
+                break
+        self._reducer.shutdown()
+        with self.camera_lock:
+            self.cam.close()
+        self._set_state('closed')
+
+    def _dispatch(self, command):
+        # Returns the command that interrupted a live run or series, if any
+        if command[0] == 'live':
+            return self._run_live()
+        if command[0] == 'series':
+            return self._run_series(command[1])
+        if command[0] in ('target', 'set', 'readout', 'roi'):
+            self._try_apply(command)
+        elif command[0] == 'stop':
+            return command
+        # A 'wake' left over from a wait needs nothing
+        return None
+
+    def _apply(self, command):
+        if command[0] == 'target':
+            self.target = command[1]
+            return
+        if command[0] == 'readout':
+            for name, value in command[1].items():
+                setattr(self, name, value)
+            return
+        if command[0] == 'roi':
+            with self.camera_lock:
+                # The camera only takes a new ROI between acquisitions
+                acquiring = self.cam.acquisition_in_progress()
+                if acquiring:
+                    self.cam.stop_acquisition()
+                try:
+                    self.cam.set_roi(**command[1])
+                    self.roi = tuple(self.cam.get_roi())
+                    self.attributes['Readout Time Calculation'] = \
+                        self.cam.get_attribute_value('Readout Time Calculation')
+                finally:
+                    # Live capture goes on with the old ROI if the camera rejected the new one
+                    if acquiring:
+                        self._start_acquisition()
+            hstart, hend, vstart, vend, hbin, vbin = self.roi
+            self.status(f"ROI set: {(hend - hstart) // hbin}x{(vend - vstart) // vbin} frames, "
+                        f"readout {self.attributes['Readout Time Calculation']:.1f} ms")
+            return
+        with self.camera_lock:
+            for name, value in command[1].items():
+                self.cam.set_attribute_value(name, value)
+                self.attributes[name] = value
+
+    def _try_apply(self, command):
+        # A command the camera rejects is reported; it must not end the engine thread
+        try:
+            self._apply(command)
+        except Exception as e:
+            self.status(f"Error applying '{command[0]}': {e}")
+
+    def _next_interrupt(self, ignored, timeout = 0):
+        """
+        Handles the commands queued while acquiring. Target and attribute changes are
+        applied right away, commands in `ignored` are dropped, and any other command is
+        returned so the current run can end. Waits up to `timeout` seconds for one.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    command = self.commands.get(timeout = remaining)
+                else:
+                    command = self.commands.get_nowait()
+            except queue.Empty:
+                return None
+            if command[0] == 'wake':
+                # Something a wait is waiting for has changed
+                return None
+            if command[0] == 'roi' and self.state == 'series':
+                # Frames of one series keep one shape
+                self.status(f"Busy with {self.state}, 'roi' ignored")
+            elif command[0] in ('target', 'set', 'readout', 'roi'):
+                self._try_apply(command)
+            elif command[0] in ignored:
+                self.status(f"Busy with {self.state}, '{command[0]}' ignored")
+            else:
+                return command
+
+    def _set_state(self, state, message = None):
+        self.state = state
+        self.status(message or state.capitalize())
+
+    def _start_acquisition(self):
+        start = time.perf_counter()
+        with self.camera_lock:
+            if self.buffer_frames is not None and self.buffer_frames != self._configured_buffer:
+                nframes = self.buffer_frames
+                if nframes > self.frames.capacity:
+                    self.status(f"Camera buffer limited to the {self.frames.capacity} frames "
+                                f"of the ring buffer, not {nframes}")
+                    nframes = self.frames.capacity
+                self.cam.setup_acquisition(mode='sequence', nframes=nframes)
+                self._configured_buffer = self.buffer_frames
+            self.cam.start_acquisition()
+        self.start_time = time.perf_counter() - start
+
+    def _capture(self, limit = None):
+        """
+        Waits for the next frame and copies it into the ring buffer, or every waiting
+        frame (at most `limit`) in batched mode. Returns the pinned (seq, img) pairs.
+        """
+        timings = self.timings
+        timings.start()
+        self.cam.wait_for_frame()
+        timings.mark(0)
+        with self.camera_lock:
+            if self.batched:
+                # A bigger batch would overwrite its own first frames in the ring buffer
+                count = max(min(self.frames.free(), limit or self.frames.capacity), 1)
+                waiting = self.cam.get_new_images_range()
+                if waiting is None:
+                    images = []
+                else:
+                    # The end of the range is exclusive, as read_multiple_images() expects it
+                    first, end = waiting
+                    images = self.cam.read_multiple_images(rng=(first, min(end, first + count)))
+            else:
+                images = [self.cam.read_oldest_image()]
+        timings.mark(1)
+        seqs = self.frames.write_many(images, pin=True)
+        captured = [(seq, self.frames.get(seq)) for seq in seqs]
+        if not captured:
+            # Dropped because the ring buffer stayed full; counted in frames.overruns
+            return captured
+        if self.batched:
+            self.batches += 1
+            self.batched_frames += len(captured)
+        img = captured[-1][1]
+        shown = self._calibrate(captured)
+        timings.mark(2)
+        self.display(shown)
+        if self.stats is not None:
+            self.stats.offer(img)
+        timings.mark(3)
+        return captured
+
+    def _calibrate(self, captured):
+        # Returns the frame to display
+        img = captured[-1][1]
+        self.calibrated = None
+        entry, master = (None, None)
+        if self.calibration is not None:
+            entry, master = self.calibration.lookup(self.attributes.get('Exposure Time'),
+                                                    self.attributes.get('Sensor Temperature Set Point'))
+        if master is None or master.shape != img.shape:
+            return img
+        if not self.calibrate_saved:
+            # Only the displayed frame is calibrated, in a copy; the ring keeps the raw frames
+            return subtract(img, master, out=np.empty_like(img))
+        for seq, frame in captured:
+            subtract(frame, master)
+        self.calibrated = entry['file']
+        return img
+
+    def _save(self, seq, img, target, **meta):
+        if self.calibrated is not None:
+            meta['calibrated'] = self.calibrated
+        # The writer reads the pinned ring buffer slot directly and releases it once saved
+        self.writer.submit(img, target,
+                           exposure=self.attributes.get('Exposure Time'),
+                           temperature=self.attributes.get('Sensor Temperature Reading'),
+                           on_done=lambda: self.frames.release(seq), **meta)
+
+    def _submitted(self):
+        self.timings.mark(4)
+        self.timings.end()
+
+    def _run_live(self):
+        self._set_state('live')
+        # Every live run, and every frame shape in it, gets its own cube when saving cubes
+        container = None
+        shape = None
+        interrupt = None
+        try:
+            if self.wait_stable:
+                interrupt = self._wait_stable("Live", ('live',))
+                if interrupt is not None:
+                    return interrupt
+            self._start_acquisition()
+            while interrupt is None:
+                for seq, img in self._capture():
+                    if img.shape != shape:
+                        if container is not None:
+                            self.writer.finish(container, wait=False)
+                        container = "live_" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+                        if shape is not None:
+                            container += f"_{img.shape[1]}x{img.shape[0]}"
+                        shape = img.shape
+                    self._save(seq, img, self.target, container=container)
+                self._submitted()
+                interrupt = self._next_interrupt(ignored=('live',))
+        except Exception as e:
+            self.status(f"Error during capture: {e}")
+        finally:
+            self._stop_acquisition()
+            # Don't wait for the writer: the queued frames are saved in the background
+            if container is not None:
+                self.writer.finish(container, wait=False)
+            self._set_state('idle', "Paused")
+        return interrupt
+
+    def _run_series(self, journal):
+        self._set_state('series')
+        container = os.path.splitext(os.path.basename(journal.path))[0]
+        interrupt = None
+        reductions = []
+        armed = False
+        self.rearms_skipped = 0
+        self.rearm_saved = 0.0
+        self.surplus = 0
+        index = None
+        try:
+            first = self._next_step(journal, -1)
+            # A series that starts with a temperature wait waits for its own set point
+            if self.wait_stable and first is not None and step_kind(first) != 'temperature':
+                interrupt = self._wait_stable("Series", ('live', 'series'))
+            for index, command in enumerate(journal.series):
+                if interrupt is not None:
+                    break
+                # Skip whatever an interrupted run of this series already finished
+                if journal.is_done(index):
+                    continue
+                if step_kind(command) == 'temperature':
+                    interrupt = self._wait_temperature(f"{index + 1}/{len(journal.series)}", *command[1:])
+                    if interrupt is not None:
+                        break
+                    journal.delay_done(index)
+                    continue
+                if step_kind(command) == 'delay':
+                    self.status(f"Series: step {index + 1}/{len(journal.series)}, delay {command[0]:g} ms")
+                    interrupt = self._next_interrupt(('live', 'series'), timeout=command[0]/1000)
+                    if interrupt is not None:
+                        break
+                    journal.delay_done(index)
+                    continue
+                num_exposures, exposure_time, target_name = command[:3]
+                stacking = command[3] if len(command) > 3 else None
+                stacker = None
+                # A resumed 'stack' step only stacks the frames taken after the resume;
+                # an unfinished 'stack-only' step starts over, since nothing was saved
+                captured = journal.saved(index)
+                if armed:
+                    # Still running from the previous step, with the same exposure time
+                    self.rearms_skipped += 1
+                    self.rearm_saved += self.start_time + self.stop_time
+                else:
+                    # Fractional exposure times go to the camera as they are, like their labels
+                    if self.attributes.get('Exposure Time') != exposure_time:
+                        self._apply(('set', {'Exposure Time': exposure_time}))
+                    self._start_acquisition()
+                    armed = True
+                # Journaled with every frame, so masters built from the series get the right one
+                set_point = self.attributes.get('Sensor Temperature Set Point')
+                while captured < num_exposures and interrupt is None:
+                    self.status(f"Series: step {index + 1}/{len(journal.series)}, "
+                                f"frame {captured + 1}/{num_exposures} of {target_name}")
+                    for seq, img in self._capture(limit=num_exposures - captured):
+                        if stacking:
+                            if stacker is None:
+                                stacker = FrameStacker(img.shape, clip=self.stack_clip)
+                            # The reduction thread holds its own pin on the frame
+                            self.frames.pin(seq)
+                            reductions.append(self._reducer.submit(self._stack, stacker, seq, img))
+                        if stacking == 'stack-only':
+                            self.frames.release(seq)
+                        else:
+                            # Every frame goes to disk right away, whatever the exposure time
+                            self._save(seq, img, target_name, container=container, command=index,
+                                       frame=captured,
+                                       on_saved=lambda file_path, index=index, frame=captured,
+                                                       set_point=set_point:
+                                           journal.frame_saved(index, frame, file_path, set_point))
+                        captured += 1
+                    self._submitted()
+                    interrupt = self._next_interrupt(('live', 'series'))
+                following = self._next_step(journal, index)
+                # A delay must not be filled with frames, so only a capture step right after
+                # this one can keep the acquisition running
+                if interrupt is not None or following is None or step_kind(following) != 'capture' \
+                        or following[1] != exposure_time:
+                    self.surplus += self._unread()
+                    self._stop_acquisition()
+                    armed = False
+                if interrupt is not None:
+                    break
+                if stacker is not None:
+                    reductions.append(self._reducer.submit(
+                        self._save_stack, journal, index, stacker, target_name, exposure_time,
+                        only=stacking == 'stack-only', set_point=set_point))
+        except Exception as e:
+            # Point at the line of the series text the failing step came from
+            where = ""
+            if index is not None and hasattr(journal.series, 'line'):
+                where = f" (step {index + 1}, line {journal.series.line(index)})"
+            self.status(f"Error during series{where}: {e}")
+            self._stop_acquisition()
+        if self.rearms_skipped:
+            self.status(f"Series: kept the acquisition running into {self.rearms_skipped} "
+                        f"steps, saving about {self.rearm_saved * 1000:.0f} ms of re-arming")
+        if self.surplus:
+            self.status(f"Series: discarded {self.surplus} frames captured past the end of their steps")
+        if any(not reduction.done() for reduction in reductions):
+            self.status("Series: waiting for stacks to be saved")
+        for reduction in reductions:
+            try:
+                reduction.result()
+            except Exception as e:
+                self.status(f"Error stacking frames: {e}")
+        self.writer.finish(container)
+        if interrupt is None and all(journal.is_done(i) for i in range(len(journal.series))):
+            journal.finish()
+            self._set_state('idle', "Series finished")
+        else:
+            # The journal stays open so the series can be resumed later
+            self._set_state('idle', "Series interrupted")
+        return interrupt
+
+    def _wait_temperature(self, step, set_point, tolerance):
+        if self.attributes.get('Sensor Temperature Set Point') != set_point:
+            self._apply(('set', {'Sensor Temperature Set Point': set_point}))
+        self.temperature.watch(set_point, tolerance)
+        return self._wait_stable(f"Series: step {step}", ('live', 'series'))
+
+    def _wait_stable(self, what, ignored):
+        # Returns the command that interrupted the wait, if any
+        monitor = self.temperature
+        if monitor.set_point is None:
+            monitor.watch(self.get_attribute('Sensor Temperature Set Point'))
+        wake = lambda state: self.commands.put(('wake',))
+        monitor.listeners.append(wake)
+        try:
+            while not monitor.stable.is_set():
+                age = monitor.age()
+                if age is None or age > TEMPERATUREPOLL:
+                    # Nothing else feeds the monitor, e.g. without telemetry
+                    monitor.update(self.get_attribute('Sensor Temperature Reading'))
+                    if monitor.stable.is_set():
+                        break
+                self.status(f"{what}: {monitor.describe()}")
+                interrupt = self._next_interrupt(ignored, timeout=TEMPERATUREPOLL)
+                if interrupt is not None:
+                    return interrupt
+        finally:
+            monitor.listeners.remove(wake)
+        return None
+
+    def _stack(self, stacker, seq, img):
+        try:
+            stacker.add(img)
+        finally:
+            self.frames.release(seq)
+
+    def _save_stack(self, journal, index, stacker, target, exposure, only, set_point = None):
+        now = datetime.datetime.now()
+        # The step index keeps stacks of a repeated target apart, even within one microsecond
+        path = os.path.join(os.path.dirname(journal.path),
+                            f"{target}_stack_{index:04d}_{now.strftime('%Y-%m-%d_%H-%M-%S-%f')}.npz")
+        temperature = self.attributes.get('Sensor Temperature Reading')
+        stacker.save(path, target=target, exposure=exposure,
+                     temperature=temperature if temperature is not None else np.nan,
+                     clip=stacker.clip if stacker.clip is not None else np.nan)
+        journal.stack_saved(index, stacker.count, path, only, set_point)
+        manifest = getattr(self.writer, 'manifest', None)
+        if manifest is not None:
+            manifest.record(seq=manifest.next_sequence(), time=now.isoformat(), target=target,
+                            exposure=exposure, temperature=temperature,
+                            file=os.path.basename(path), offset=0,
+                            stack=stacker.count, rejected=stacker.rejected())
+
+    def _unread(self):
+        # Frames waiting in the camera buffer, which stopping the acquisition discards
+        try:
+            with self.camera_lock:
+                waiting = self.cam.get_new_images_range()
+        except Exception:
+            return 0
+        # pylablib gives the range with an exclusive end
+        return 0 if waiting is None else waiting[1] - waiting[0]
+
+    def _stop_acquisition(self):
+        start = time.perf_counter()
+        try:
+            with self.camera_lock:
+                self.cam.stop_acquisition()
+        except Exception as e:
+            self.status(f"Error stopping acquisition: {e}")
+        self.stop_time = time.perf_counter() - start
+
+    def _next_step(self, journal, index):
+        # The series step that will run after step `index`, if any
+        for following in range(index + 1, len(journal.series)):
+            if not journal.is_done(following):
+                return journal.series[following]
+        return None
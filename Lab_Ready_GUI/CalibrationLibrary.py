@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Library of master darks and biases for the PIXIS. Masters are built from saved
+dark and bias series (the frames or the stacks listed in a series journal) with a
+sigma-clipped FrameStacker mean, stored as float32 .npy files in the library folder
+and listed in calibration.json with their exposure time, sensor temperature set
+point and frame count.
+
+lookup(exposure, set_point) finds the master for a frame: the dark with the same
+exposure and set point, or else the bias at that set point. The matching masters
+are kept preloaded as uint16 arrays in a small LRU cache, so subtracting one from
+every frame costs two vectorized passes over the frame and no allocation.
+"""
+
+import collections
+import datetime
+import json
+import os
+import threading
+
+import numpy as np
+
+from Codecs import load_frame
+from CubeFile import CubeReader
+from FrameStacker import FrameStacker
+from SeriesPlan import compile_series, format_exposure, step_kind
+
+# Largest set point difference (deg C) for which a master still matches
+SETPOINTTOLERANCE = 0.5
+
+
+def subtract(img, master, out = None):
+    """Saturating img - master (negative values become 0); in place unless `out` is given."""
+    if out is None:
+        out = img
+    # img - min(img, master) == max(img, master) - master, without a temporary
+    np.maximum(img, master, out = out)
+    np.subtract(out, master, out = out)
+    return out
+
+
+def journal_frames(journal_path):
+    """
+    Yields ('frame', command index, frame, 1, set point) for every frame listed in a
+    series journal, and ('stack', command index, stack, frames, set point) for every
+    saved stack, with the number of frames it stands for; the set point is None when
+    the journal didn't record one. The frames of a step that saved a stack are left
+    out, since the stack already stands for them.
+    """
+    cubes = {}
+    with open(journal_path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    stacked = {entry['command'] for entry in entries if entry['event'] == 'stack'}
+    for entry in entries:
+        if entry['event'] == 'frame' and entry['command'] not in stacked:
+            path = entry['file']
+            if path.endswith('.cube'):
+                if path not in cubes:
+                    reader = CubeReader(path)
+                    # Frames of each command, in the order they were appended
+                    cubes[path] = (reader, collections.defaultdict(collections.deque))
+                    for position, meta in enumerate(reader.index):
+                        cubes[path][1][meta.get('command')].append(position)
+                reader, positions = cubes[path]
+                if positions[entry['command']]:
+                    yield ('frame', entry['command'], reader.frames[positions[entry['command']].popleft()], 1,
+                           entry.get('set_point'))
+            else:
+                yield 'frame', entry['command'], load_frame(path), 1, entry.get('set_point')
+        elif entry['event'] == 'stack':
+            with np.load(entry['file']) as stack:
+                yield 'stack', entry['command'], stack['clipped_mean'], entry['frames'], entry.get('set_point')
+
+
+class CalibrationLibrary(object):
+    def __init__(self, folder, cache_size = 8):
+        self.folder = folder
+        os.makedirs(folder, exist_ok = True)
+        self.index_path = os.path.join(folder, 'calibration.json')
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._matches = {}
+        self._lock = threading.Lock()
+
+    def _save_index(self):
+        with open(self.index_path + '.part', 'w') as f:
+            json.dump(self.entries, f, indent = 1)
+        os.replace(self.index_path + '.part', self.index_path)
+
+    def add(self, kind, exposure, set_point, master, frames, source = None):
+        """Stores `master` as the `kind` ('dark' or 'bias') master for exposure and set point."""
+        filename = f"master_{kind}_{format_exposure(exposure)}ms_{set_point:g}C.npy"
+        path = os.path.join(self.folder, filename)
+        with open(path + '.part', 'wb') as f:
+            np.save(f, np.asarray(master, dtype = np.float32))
+        os.replace(path + '.part', path)
+        entry = {'kind': kind, 'exposure': exposure, 'set_point': set_point, 'file': filename,
+                 'frames': frames, 'source': source, 'created': datetime.datetime.now().isoformat()}
+        with self._lock:
+            # A new master replaces the old one for the same key
+            self.entries = [e for e in self.entries if e['file'] != filename] + [entry]
+            self._cache.pop(filename, None)
+            self._matches.clear()
+            self._save_index()
+        return entry
+
+    def build_from_journal(self, journal_path, set_point, clip = 3.0):
+        """
+        Builds one master per exposure time and sensor set point of a saved dark or bias
+        series, from the frames and stacks of every step with that exposure time. Each
+        frame counts at the set point journaled with it; older journals fall back to the
+        set point of the series' last 'wait temperature' step before it, and to
+        `set_point` before any. Steps with a zero exposure or 'bias' in their target
+        name make biases, all others darks. Returns the new entries.
+        """
+        with open(journal_path) as f:
+            begin = json.loads(f.readline())
+        series = compile_series(begin['source']) if 'source' in begin else begin['series']
+        step_set_points = {}
+        current = set_point
+        for index, step in enumerate(series):
+            if step_kind(step) == 'temperature':
+                current = step[1]
+            step_set_points[index] = current
+
+        def key(index, journaled):
+            num_exposures, exposure, target = series[index][:3]
+            kind = 'bias' if exposure == 0 or 'bias' in target.lower() else 'dark'
+            return kind, exposure, journaled if journaled is not None else step_set_points[index]
+
+        # (kind, exposure, set point) -> (sum of stacks weighted by their frames, frame count)
+        stacks = {}
+        stackers = {}
+        for event, index, img, frames, journaled in journal_frames(journal_path):
+            if event == 'stack':
+                # Stacks are already clipped, so they count with the weight of their frames
+                group = key(index, journaled)
+                total, count = stacks.get(group, (0.0, 0))
+                stacks[group] = (total + img.astype(np.float64) * frames, count + frames)
+                continue
+            group = key(index, journaled)
+            if group not in stackers:
+                stackers[group] = FrameStacker(img.shape, clip = clip)
+            stackers[group].add(img)
+        for group, stacker in stackers.items():
+            total, count = stacks.get(group, (0.0, 0))
+            stacks[group] = (total + stacker.clipped_mean() * stacker.count, count + stacker.count)
+        entries = []
+        # Every master file is written once, with all the frames of its exposure time
+        for (kind, exposure, step_set_point), (total, count) in sorted(stacks.items()):
+            entries.append(self.add(kind, exposure, step_set_point, total / count, count,
+                                    source = os.path.basename(journal_path)))
+        return entries
+
+    def find(self, exposure, set_point):
+        """Entry of the master matching a frame, or None."""
+        if exposure is None or set_point is None:
+            return None
+        candidates = [e for e in self.entries if abs(e['set_point'] - set_point) <= SETPOINTTOLERANCE]
+        for entry in reversed(candidates):
+            if entry['kind'] == 'dark' and entry['exposure'] == exposure:
+                return entry
+        for entry in reversed(candidates):
+            if entry['kind'] == 'bias':
+                return entry
+        return None
+
+    def master(self, entry):
+        """The master of `entry` as a uint16 array, from the LRU cache when it is loaded."""
+        filename = entry['file']
+        with self._lock:
+            if filename in self._cache:
+                self._cache.move_to_end(filename)
+                return self._cache[filename]
+        master = np.load(os.path.join(self.folder, filename))
+        master = np.clip(np.rint(master), 0, 65535).astype(np.uint16)
+        with self._lock:
+            self._cache[filename] = master
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last = False)
+        return master
+
+    def lookup(self, exposure, set_point):
+        """(entry, uint16 master) matching a frame, or (None, None)."""
+        key = (exposure, set_point)
+        if key not in self._matches:
+            self._matches[key] = self.find(exposure, set_point)
+        entry = self._matches[key]
+        if entry is None:
+            return None, None
+        return entry, self.master(entry)
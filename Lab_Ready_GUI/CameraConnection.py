@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Camera discovery and connection, kept out of module import time so a GUI or a
+script can start right away and connect whenever it is ready (typically on a
+background thread, since opening the PIXIS takes seconds). pylablib is only
+imported here, the first time a real camera is opened. check_roi() validates a
+region of interest and binning against the sensor before it goes to the camera.
+"""
+
+import time
+
+
+def open_camera(serial = None, dll = None, simulate = False, exposure = 10, report = print):
+    """
+    Opens the PIXIS with the given serial number (the first camera found if None),
+    or the simulated camera, and sets the initial exposure time in ms. `dll` is the
+    path of Picam.dll. Raises whatever the driver raises when the camera is absent
+    or busy.
+    """
+    start = time.perf_counter()
+    if simulate:
+        from SimulatedCamera import SimulatedPicamCamera, list_cameras
+        report(f"Cameras: {list_cameras()}")
+        cam = SimulatedPicamCamera()
+    else:
+        import pylablib as pll
+        from pylablib.devices import PrincetonInstruments
+        if dll:
+            pll.par["devices/dlls/picam"] = dll
+        cameras = PrincetonInstruments.list_cameras()
+        report(f"Cameras: {cameras}")
+        if serial is None and not cameras:
+            raise RuntimeError("No camera found")
+        cam = PrincetonInstruments.PicamCamera(serial)
+    try:
+        cam.set_attribute_value('Exposure Time', exposure)
+    except Exception:
+        cam.close()
+        raise
+    report(f"Camera opened in {time.perf_counter() - start:.2f} s")
+    return cam
+
+
+def check_roi(roi, detector_size):
+    """
+    Checks a region of interest (hstart, hend, vstart, vend, hbin, vbin), in sensor
+    pixels with exclusive ends, against the (width, height) of the sensor. Raises a
+    ValueError saying what is wrong; returns the frame shape (rows, cols) it reads.
+    """
+    hstart, hend, vstart, vend, hbin, vbin = roi
+    width, height = detector_size
+    if not (0 <= hstart < hend <= width):
+        raise ValueError(f"Columns {hstart}-{hend} are not inside the sensor width 0-{width}")
+    if not (0 <= vstart < vend <= height):
+        raise ValueError(f"Rows {vstart}-{vend} are not inside the sensor height 0-{height}")
+    if hbin < 1 or vbin < 1:
+        raise ValueError("Binning must be at least 1")
+    if (hend - hstart) % hbin or (vend - vstart) % vbin:
+        raise ValueError(f"A {hend - hstart}x{vend - vstart} region does not divide into "
+                         f"{hbin}x{vbin} bins")
+    return (vend - vstart) // vbin, (hend - hstart) // hbin
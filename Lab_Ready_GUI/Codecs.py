@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Frame codecs used when saving one file per frame. Every codec has the same
+interface (encode an image to bytes, decode bytes back to an image) and is picked
+with a short name:
+
+    npz                      np.savez_compressed, the original .npz files
+    raw                      uncompressed bytes
+    zlib:6                   zlib at level 6 (any standard library compressor:
+                             zlib, bz2 or lzma, with an optional level)
+    shuffle-zlib:1           byte shuffle before compressing
+    delta-shuffle-zlib:1     row-wise difference of the 16-bit pixels, then shuffle
+
+Frames saved with anything but npz go into .frame files: one JSON header line
+(codec, shape, dtype) followed by the encoded payload; load_frame() reads both.
+
+Running this file benchmarks the codecs on simulated frames and, optionally, on
+real .npz/.frame/.cube files, reporting encode/decode speed in MB/s and the
+compression ratio:
+
+    python Codecs.py --codecs raw zlib:1 shuffle-zlib:1 --frames dark_0001.npz
+"""
+
+import argparse
+import bz2
+import io
+import json
+import lzma
+import time
+import zlib
+
+import numpy as np
+
+COMPRESSORS = {
+    'zlib': (zlib.compress, zlib.decompress, 6),
+    'bz2': (bz2.compress, bz2.decompress, 9),
+    'lzma': (lambda data, level: lzma.compress(data, preset = level), lzma.decompress, 6),
+}
+
+# Codecs offered in the GUI and benchmarked by default
+CODECCHOICES = ['npz', 'raw', 'zlib:1', 'zlib:6', 'shuffle-zlib:1', 'delta-shuffle-zlib:1',
+                'delta-shuffle-bz2:9', 'delta-shuffle-lzma:1']
+
+
+class NpzCodec(object):
+    name = 'npz'
+    extension = '.npz'
+
+    def encode(self, img):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, array = img)
+        return buffer.getvalue()
+
+    def decode(self, payload, shape = None, dtype = None):
+        return np.load(io.BytesIO(payload))['array']
+
+
+class FilterCodec(object):
+    """Optional delta and byte-shuffle filters followed by an optional compressor."""
+    extension = '.frame'
+
+    def __init__(self, compressor = None, level = None, shuffle = False, delta = False):
+        self.compressor = compressor
+        self.level = level
+        self.shuffle = shuffle
+        self.delta = delta
+        parts = (['delta'] if delta else []) + (['shuffle'] if shuffle else [])
+        parts.append(compressor or 'raw')
+        self.name = '-'.join(parts) + (f":{level}" if level is not None else '')
+
+    def encode(self, img):
+        data = np.ascontiguousarray(img)
+        if self.delta:
+            # Neighbouring pixels are similar, so their differences are small numbers
+            data = np.diff(data, axis = -1, prepend = np.zeros_like(data[..., :1]))
+        data = data.view(np.uint8)
+        if self.shuffle:
+            # Group the low bytes and the high bytes of all pixels together
+            data = np.ascontiguousarray(data.reshape(-1, img.dtype.itemsize).T)
+        payload = data.tobytes()
+        if self.compressor is not None:
+            compress, decompress, default_level = COMPRESSORS[self.compressor]
+            level = default_level if self.level is None else self.level
+            payload = compress(payload, level)
+        return payload
+
+    def decode(self, payload, shape, dtype):
+        dtype = np.dtype(dtype)
+        if self.compressor is not None:
+            payload = COMPRESSORS[self.compressor][1](payload)
+        data = np.frombuffer(payload, dtype = np.uint8)
+        if self.shuffle:
+            data = np.ascontiguousarray(data.reshape(dtype.itemsize, -1).T)
+        img = data.view(dtype).reshape(shape)
+        if self.delta:
+            img = np.cumsum(img, axis = -1, dtype = dtype)
+        return img
+
+
+def get_codec(name):
+    if name == 'npz':
+        return NpzCodec()
+    spec, _, level = name.partition(':')
+    parts = spec.split('-')
+    compressor = parts[-1]
+    if compressor != 'raw' and compressor not in COMPRESSORS:
+        raise ValueError(f"Unknown codec: {name}")
+    unknown = set(parts[:-1]) - {'delta', 'shuffle'}
+    if unknown:
+        raise ValueError(f"Unknown codec filter(s) {sorted(unknown)} in {name}")
+    return FilterCodec(None if compressor == 'raw' else compressor,
+                       int(level) if level else None,
+                       shuffle = 'shuffle' in parts, delta = 'delta' in parts)
+
+
+def frame_bytes(img, codec):
+    payload = codec.encode(img)
+    if isinstance(codec, NpzCodec):
+        return payload
+    header = {'codec': codec.name, 'shape': list(img.shape), 'dtype': img.dtype.str}
+    return json.dumps(header).encode() + b'\n' + payload
+
+
+def load_frame(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith('.npz'):
+        return NpzCodec().decode(data)
+    header, _, payload = data.partition(b'\n')
+    header = json.loads(header)
+    return get_codec(header['codec']).decode(payload, header['shape'], header['dtype'])
+
+
+def simulated_frames(count = 4, shape = (1024, 1024), seed = 0):
+    # Bias level, dark current, photon and read noise, hot pixels and a few cosmic rays
+    rng = np.random.default_rng(seed)
+    hot = rng.integers(0, shape[0] * shape[1], 200)
+    frames = []
+    for i in range(count):
+        img = 600 + rng.poisson(40, shape) + rng.normal(0, 8, shape)
+        img.flat[hot] += 20000
+        for ray in rng.integers(0, shape[0] * shape[1], 20):
+            img.flat[ray:ray + 3] = 65000
+        frames.append(np.clip(img, 0, 65535).astype(np.uint16))
+    return frames
+
+
+def read_frames(paths):
+    frames = []
+    for path in paths:
+        if path.endswith('.cube'):
+            from CubeFile import CubeReader
+            frames.extend(np.array(frame) for frame in CubeReader(path).frames)
+        else:
+            frames.append(load_frame(path))
+    return frames
+
+
+def benchmark(codec, frames, repeat = 3):
+    raw_bytes = sum(frame.nbytes for frame in frames)
+    encode_time = decode_time = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        payloads = [codec.encode(frame) for frame in frames]
+        encode_time = min(encode_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        decoded = [codec.decode(payload, frame.shape, frame.dtype)
+                   for payload, frame in zip(payloads, frames)]
+        decode_time = min(decode_time, time.perf_counter() - start)
+    for frame, result in zip(frames, decoded):
+        if not np.array_equal(frame, result):
+            raise AssertionError(f"{codec.name} did not reproduce the frame")
+    return {
+        'codec': codec.name,
+        'encode_mb_per_s': raw_bytes / encode_time / 1e6,
+        'decode_mb_per_s': raw_bytes / decode_time / 1e6,
+        'ratio': raw_bytes / sum(len(payload) for payload in payloads),
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the frame codecs.")
+    parser.add_argument('--codecs', nargs = '+', default = CODECCHOICES)
+    parser.add_argument('--frames', nargs = '*', default = [],
+                        help = ".npz, .frame or .cube files with real frames")
+    parser.add_argument('--simulated', type = int, default = 4,
+                        help = "number of simulated 1024x1024 frames")
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args(argv)
+
+    sets = []
+    if args.simulated:
+        sets.append(('simulated', simulated_frames(args.simulated)))
+    if args.frames:
+        sets.append(('real', read_frames(args.frames)))
+    for label, frames in sets:
+        print(f"{label}: {len(frames)} frame(s) of {frames[0].shape}")
+        print(f"{'codec':<24}{'encode MB/s':>14}{'decode MB/s':>14}{'ratio':>9}")
+        for name in args.codecs:
+            result = benchmark(get_codec(name), frames, args.repeat)
+            print(f"{result['codec']:<24}{result['encode_mb_per_s']:>14.1f}"
+                  f"{result['decode_mb_per_s']:>14.1f}{result['ratio']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Append-only single-file container ("cube") for a series of frames. Instead of one
+.npz per frame, every frame of a series is appended to one .cube file:
+
+    [ 4096 byte header ][ frame 0 ][ frame 1 ] ... [ frame N-1 ][ index ]
+
+The header is fixed-size, the frames are raw uint16 blocks of identical shape and
+the trailing index is a JSON list with the metadata of each frame (target, time,
+exposure, ...). Because the frames are uncompressed and evenly spaced, the whole
+cube can be opened with np.memmap and any frame or slice read without touching the
+rest of the file. A cube whose writer crashed has no index yet; its frames are still
+readable and it can be reopened for appending.
+"""
+
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+MAGIC = b"SHIMCUBE"
+VERSION = 1
+HEADERSIZE = 4096
+# magic, version, dtype, rows, cols, frame count, index offset, index length
+HEADERFORMAT = "<8sI8sIIQQQ"
+
+
+def _read_header(f):
+    f.seek(0)
+    magic, version, dtype, rows, cols, nframes, index_offset, index_length = struct.unpack(
+        HEADERFORMAT, f.read(struct.calcsize(HEADERFORMAT)))
+    if magic != MAGIC:
+        raise ValueError("Not a cube file")
+    return {
+        'version': version,
+        'dtype': np.dtype(dtype.rstrip(b'\0').decode()),
+        'shape': (rows, cols),
+        'nframes': nframes,
+        'index_offset': index_offset,
+        'index_length': index_length,
+    }
+
+
+class CubeWriter(object):
+    def __init__(self, path, shape = (1024, 1024), dtype = np.uint16):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.index = []
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._write_header(0, 0)
+        self._file.seek(HEADERSIZE)
+
+    @classmethod
+    def open_append(cls, path):
+        """Reopens an existing cube, finished or not, to append more frames."""
+        with open(path, 'rb') as f:
+            header = _read_header(f)
+        cube = cls.__new__(cls)
+        cube.path = path
+        cube.shape = header['shape']
+        cube.dtype = header['dtype']
+        cube.frame_bytes = int(np.prod(cube.shape)) * cube.dtype.itemsize
+        cube._lock = threading.Lock()
+        cube._file = open(path, 'r+b')
+        if header['index_offset']:
+            cube._file.seek(header['index_offset'])
+            cube.index = json.loads(cube._file.read(header['index_length']))
+            nframes = header['nframes']
+        else:
+            # Crashed before the index was written: keep every complete frame
+            nframes = (os.path.getsize(path) - HEADERSIZE) // cube.frame_bytes
+            cube.index = [{} for i in range(nframes)]
+        cube._file.truncate(HEADERSIZE + nframes * cube.frame_bytes)
+        cube._write_header(0, 0)
+        cube._file.seek(HEADERSIZE + nframes * cube.frame_bytes)
+        return cube
+
+    def _write_header(self, index_offset, index_length):
+        self._file.seek(0)
+        header = struct.pack(HEADERFORMAT, MAGIC, VERSION, self.dtype.str.encode(),
+                             self.shape[0], self.shape[1], len(self.index),
+                             index_offset, index_length)
+        self._file.write(header.ljust(HEADERSIZE, b'\0'))
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, img, **meta):
+        """Appends one frame and returns its position in the cube."""
+        if img.shape != self.shape:
+            raise ValueError(f"Frame shape {img.shape} does not match cube shape {self.shape}")
+        img = np.ascontiguousarray(img, dtype = self.dtype)
+        with self._lock:
+            self._file.write(memoryview(img).cast('B'))
+            # Hand the frame to the OS right away so a GUI crash cannot lose it
+            self._file.flush()
+            self.index.append(meta)
+            return len(self.index) - 1
+
+    def offset(self, position):
+        return HEADERSIZE + position * self.frame_bytes
+
+    def close(self):
+        with self._lock:
+            index_offset = HEADERSIZE + len(self.index) * self.frame_bytes
+            payload = json.dumps(self.index, default = str).encode()
+            self._file.seek(index_offset)
+            self._file.write(payload)
+            self._file.truncate()
+            self._write_header(index_offset, len(payload))
+            self._file.close()
+
+
+class CubeReader(object):
+    """Memory-mapped view of a cube; reader.frames[i] or reader.frames[a:b] reads lazily."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = _read_header(f)
+            self.shape = header['shape']
+            self.dtype = header['dtype']
+            frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            if header['index_offset']:
+                nframes = header['nframes']
+                f.seek(header['index_offset'])
+                self.index = json.loads(f.read(header['index_length']))
+            else:
+                nframes = (os.path.getsize(path) - HEADERSIZE) // frame_bytes
+                self.index = [{} for i in range(nframes)]
+        self.complete = bool(header['index_offset'])
+        self.frames = np.memmap(path, dtype = self.dtype, mode = 'r', offset = HEADERSIZE,
+                                shape = (nframes,) + tuple(self.shape))
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, item):
+        return self.frames[item]
+
+
+# FrameWriter sink that appends every frame to <container>.cube
+class CubeSink(object):
+    def __init__(self, folder):
+        self.folder = folder
+        self.cubes = {}
+        self._lock = threading.Lock()
+
+    def encode(self, img):
+        # Cubes hold raw frames so they stay memory-mappable
+        return img
+
+    def _cube(self, container, shape, dtype):
+        with self._lock:
+            if container not in self.cubes:
+                path = os.path.join(self.folder, f"{container}.cube")
+                if os.path.exists(path):
+                    self.cubes[container] = CubeWriter.open_append(path)
+                else:
+                    self.cubes[container] = CubeWriter(path, shape, dtype)
+            return self.cubes[container]
+
+    def write(self, payload, meta):
+        meta = dict(meta)
+        container = meta.pop('container', meta['target'])
+        cube = self._cube(container, payload.shape, payload.dtype)
+        meta['time'] = meta['time'].isoformat()
+        position = cube.append(payload, **meta)
+        return cube.path, cube.offset(position)
+
+    def finish(self, container):
+        with self._lock:
+            cube = self.cubes.pop(container, None)
+        if cube is not None:
+            cube.close()
+
+    def close(self):
+        for container in list(self.cubes):
+            self.finish(container)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Display limits for the live view. Instead of a full-frame np.max per frame, the
+limits come from a strided subsample of the frame (every `stride`-th row and
+column), so their cost does not grow with the frame size, and a hot pixel or a
+cosmic ray does not wash out the display. Modes:
+
+    minmax      smallest and largest value of the subsample
+    percentile  `low` and `high` percentiles, read off an np.bincount histogram of
+                the uint16 subsample instead of sorting it
+    zscale      IRAF-like zscale: a line fitted to the sorted subsample, with
+                outliers rejected, stretched around the median by `contrast`
+    fixed       the `fixed` limits
+
+The limits are smoothed over successive frames with an exponential moving average
+(`smoothing` is the weight of the newest frame) and rounded to whole counts, so the
+view does not flicker and the fast view can reuse its lookup table.
+"""
+
+import numpy as np
+
+MODES = ('minmax', 'percentile', 'zscale', 'fixed')
+
+
+class DisplayScaling(object):
+    def __init__(self, mode = 'percentile', low = 0.5, high = 99.5, stride = 4, smoothing = 0.3,
+                 fixed = (0, 65535), contrast = 0.25, zscale_samples = 1000):
+        self.mode = mode
+        self.low = low
+        self.high = high
+        self.stride = stride
+        self.smoothing = smoothing
+        self.fixed = fixed
+        self.contrast = contrast
+        self.zscale_samples = zscale_samples
+        self.histogram = None
+        self._limits = None
+
+    def set_mode(self, mode):
+        if mode not in MODES:
+            raise ValueError(f"Unknown scaling mode '{mode}', expected one of {MODES}")
+        self.mode = mode
+        self.reset()
+
+    def set_fixed(self, vmin, vmax):
+        self.fixed = (vmin, vmax)
+
+    def reset(self):
+        # The next frame sets the limits without smoothing
+        self._limits = None
+
+    def sample(self, img):
+        return img[::self.stride, ::self.stride]
+
+    def raw_limits(self, img):
+        """Limits of `img` alone, without smoothing."""
+        if self.mode == 'fixed':
+            return self.fixed
+        sample = self.sample(img)
+        if self.mode == 'minmax':
+            return sample.min(), sample.max()
+        if self.mode == 'zscale':
+            return self._zscale(sample)
+        return self._percentiles(sample)
+
+    def _percentiles(self, sample):
+        if sample.dtype.kind != 'u':
+            return tuple(np.percentile(sample, (self.low, self.high)))
+        self.histogram = np.bincount(sample.ravel())
+        cumulative = np.cumsum(self.histogram)
+        levels = np.array([self.low, self.high]) / 100 * cumulative[-1]
+        vmin, vmax = np.searchsorted(cumulative, levels)
+        return vmin, vmax
+
+    def _zscale(self, sample, max_reject = 0.5, rejection = 2.5, iterations = 5):
+        values = sample.ravel()
+        if len(values) > self.zscale_samples:
+            values = values[::len(values) // self.zscale_samples]
+        values = np.sort(values).astype(np.float64)
+        n = len(values)
+        median = values[n // 2]
+        x = np.arange(n)
+        keep = np.ones(n, dtype = bool)
+        slope = 0.0
+        for i in range(iterations):
+            if keep.sum() < max(n * (1 - max_reject), 2):
+                break
+            slope, intercept = np.polyfit(x[keep], values[keep], 1)
+            residuals = values - (slope * x + intercept)
+            sigma = residuals[keep].std()
+            new_keep = np.abs(residuals) < rejection * sigma if sigma > 0 else keep
+            if np.array_equal(new_keep, keep):
+                break
+            keep = new_keep
+        vmin = max(values[0], median - (n // 2) * slope / self.contrast)
+        vmax = min(values[-1], median + (n - 1 - n // 2) * slope / self.contrast)
+        return vmin, vmax
+
+    def limits(self, img):
+        """Smoothed (vmin, vmax) for displaying `img`."""
+        vmin, vmax = self.raw_limits(img)
+        if self._limits is not None and self.mode != 'fixed':
+            previous_min, previous_max = self._limits
+            vmin = previous_min + self.smoothing * (vmin - previous_min)
+            vmax = previous_max + self.smoothing * (vmax - previous_max)
+        self._limits = (float(vmin), float(vmax))
+        vmin, vmax = round(self._limits[0]), round(self._limits[1])
+        return vmin, max(vmax, vmin + 1)
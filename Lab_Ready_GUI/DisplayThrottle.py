@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Latest-frame-wins hand-off between acquisition and the display. Acquisition threads
+call offer() for every frame, which only replaces the single pending frame, so
+frames never pile up in the Qt event queue. A timer in the GUI thread renders the
+pending frame at most `max_rate` times per second; frames replaced before they were
+shown are counted as skipped. Saving is not affected since the writer gets every
+frame separately.
+"""
+
+import threading
+
+from PyQt5 import QtCore
+
+
+class DisplayThrottle(QtCore.QObject):
+    def __init__(self, render, max_rate = 20.0, parent = None):
+        super().__init__(parent)
+        self.render = render
+        self.offered = 0
+        self.rendered = 0
+        self.skipped = 0
+        self._pending = None
+        self._lock = threading.Lock()
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self._render_pending)
+        self.set_max_rate(max_rate)
+
+    def set_max_rate(self, max_rate):
+        self.max_rate = max_rate
+        self._timer.start(max(int(1000 / max_rate), 1))
+
+    def offer(self, img):
+        """Thread-safe: makes `img` the next frame to display, replacing any older one."""
+        with self._lock:
+            if self._pending is not None:
+                self.skipped += 1
+            self._pending = img
+            self.offered += 1
+
+    def _render_pending(self):
+        with self._lock:
+            img, self._pending = self._pending, None
+        if img is not None:
+            self.render(img)
+            self.rendered += 1
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Fast live view for camera frames, used instead of the matplotlib imshow canvas.
+A uint16 frame is mapped to 8-bit colormap indices with a precomputed 65536-entry
+lookup table (one vectorized np.take), the index array is wrapped without copying
+in an indexed QImage whose color table holds the colormap, and the widget paints
+that QImage directly. The lookup table is only rebuilt when the display limits change.
+HistogramView draws the histogram of the statistics panel.
+"""
+
+import collections
+import time
+
+import numpy as np
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+
+def colormap_table(cmap = 'Blues'):
+    # 256 QRgb values of a matplotlib colormap, or a gray ramp without matplotlib
+    try:
+        import matplotlib
+        rgba = matplotlib.colormaps[cmap](np.linspace(0, 1, 256))
+    except (ImportError, KeyError):
+        rgba = np.repeat(np.linspace(0, 1, 256)[:, None], 4, axis = 1)
+    rgb = (rgba[:, :3] * 255).astype(np.uint32)
+    return [int(0xFF000000 | (r << 16) | (g << 8) | b) for r, g, b in rgb]
+
+
+# Rolling frames-per-second estimate over the last `window` frames
+class RateCounter(object):
+    def __init__(self, window = 30):
+        self._times = collections.deque(maxlen = window)
+
+    def tick(self):
+        self._times.append(time.perf_counter())
+
+    @property
+    def rate(self):
+        if len(self._times) < 2 or time.perf_counter() - self._times[-1] > 2.0:
+            return 0.0
+        return (len(self._times) - 1) / (self._times[-1] - self._times[0])
+
+
+class FastImageView(QtWidgets.QWidget):
+    def __init__(self, parent = None, cmap = 'Blues'):
+        super().__init__(parent)
+        self.cmap = cmap
+        # Built with the first frame, which keeps matplotlib out of startup
+        self.color_table = None
+        self.rate = RateCounter()
+        self._limits = None
+        self._lut = None
+        self._indices = None
+        self._image = None
+
+    def _lookup(self, vmin, vmax):
+        if self._limits != (vmin, vmax):
+            scale = 255.0 / max(vmax - vmin, 1)
+            levels = (np.arange(65536, dtype = np.float32) - vmin) * scale
+            self._lut = np.clip(levels, 0, 255).astype(np.uint8)
+            self._limits = (vmin, vmax)
+        return self._lut
+
+    def set_image(self, img, vmin, vmax):
+        if self.color_table is None:
+            self.color_table = colormap_table(self.cmap)
+        lut = self._lookup(vmin, vmax)
+        # Keep a reference: the QImage below points straight into this array
+        self._indices = np.take(lut, img)
+        rows, cols = self._indices.shape
+        self._image = QtGui.QImage(self._indices.data, cols, rows, cols, QtGui.QImage.Format_Indexed8)
+        self._image.setColorTable(self.color_table)
+        self.rate.tick()
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), self.palette().window())
+        if self._image is not None:
+            size = self._image.size().scaled(self.size(), QtCore.Qt.KeepAspectRatio)
+            target = QtCore.QRect(QtCore.QPoint(0, 0), size)
+            target.moveCenter(self.rect().center())
+            painter.drawImage(target, self._image)
+        painter.end()
+
+
+# Bar plot of a frame histogram (log counts) for the statistics panel
+class HistogramView(QtWidgets.QWidget):
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self._counts = None
+        self._edges = None
+
+    def set_histogram(self, counts, edges):
+        self._counts = np.asarray(counts)
+        self._edges = edges
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtCore.Qt.white)
+        painter.setPen(QtCore.Qt.gray)
+        painter.drawRect(self.rect().adjusted(0, 0, -1, -1))
+        if self._counts is not None and len(self._counts):
+            heights = np.log10(self._counts + 1.0)
+            heights /= max(heights.max(), 1e-9)
+            label = 14
+            width = self.width() / len(heights)
+            plot = self.height() - label - 2
+            color = QtGui.QColor(31, 119, 180)
+            for i, h in enumerate(heights):
+                bar = int(round(h * plot))
+                painter.fillRect(QtCore.QRectF(i * width, 1 + plot - bar, max(width, 1), bar), color)
+            painter.setPen(QtCore.Qt.black)
+            painter.drawText(2, self.height() - 3, str(self._edges[0]))
+            text = str(self._edges[-1] - 1)
+            painter.drawText(self.width() - painter.fontMetrics().width(text) - 2, self.height() - 3, text)
+        painter.end()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Preallocated ring buffer for camera frames. All frames live in one contiguous
+(capacity x rows x cols) uint16 array that is allocated once, so memory use has a
+hard limit of capacity * frame size no matter how long a series runs. Acquisition
+copies each new frame into the next slot and consumers (display, writer,
+statistics) read views of the slots without copying.
+
+Every frame gets a sequence number. A slot can be pinned while a consumer still
+needs it, and write() waits for a pinned slot to be released before reusing it. A
+slot is never overwritten while it is pinned: if it is still pinned after
+`pin_timeout`, the new frame is dropped instead and counted in `overruns`. A frame
+written with pin=True is pinned as it is written, and free() tells how many frames
+fit before the next pinned slot, so a batch can be sized not to overwrite itself.
+"""
+
+import threading
+
+import numpy as np
+
+
+class FrameRingBuffer(object):
+    def __init__(self, capacity, shape = (1024, 1024), dtype = np.uint16, pin_timeout = 5.0):
+        self.capacity = capacity
+        self.pin_timeout = pin_timeout
+        self._cond = threading.Condition()
+        # Sequence numbers continue across reallocations, so a late release() of a
+        # frame from before a shape change cannot unpin a new frame
+        self.count = 0
+        self.overruns = 0
+        self._allocate(tuple(shape), dtype)
+
+    def _allocate(self, shape, dtype):
+        self.frames = np.zeros((self.capacity,) + shape, dtype = dtype)
+        self._sequence = np.full(self.capacity, -1, dtype = np.int64)
+        self._pins = np.zeros(self.capacity, dtype = np.int64)
+
+    @property
+    def shape(self):
+        return self.frames.shape[1:]
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def free(self):
+        """Number of frames that can be written before reaching a pinned slot."""
+        with self._cond:
+            for offset in range(self.capacity):
+                if self._pins[(self.count + offset) % self.capacity] > 0:
+                    return offset
+            return self.capacity
+
+    def write(self, img, pin = False):
+        """
+        Copies `img` into the next slot and returns its sequence number, or None if the
+        frame was dropped because the slot stayed pinned. With pin=True the new frame
+        is pinned before any other thread can see it.
+        """
+        with self._cond:
+            if img.shape != self.shape:
+                self._allocate(img.shape, self.frames.dtype)
+            seq = self.count
+            slot = seq % self.capacity
+            if self._pins[slot] > 0:
+                # A consumer still holds the frame in this slot; give it a chance to finish
+                if not self._cond.wait_for(lambda: self._pins[slot] == 0, self.pin_timeout):
+                    # Overwriting it would give the consumer another frame's pixels
+                    self.overruns += 1
+                    return None
+            np.copyto(self.frames[slot], img)
+            self._sequence[slot] = seq
+            if pin:
+                self._pins[slot] += 1
+            self.count += 1
+            return seq
+
+    def write_many(self, images, pin = False):
+        """Copies a batch of frames into consecutive slots; returns the sequence numbers of those written."""
+        with self._cond:
+            seqs = [self.write(img, pin) for img in images]
+        return [seq for seq in seqs if seq is not None]
+
+    def valid(self, seq):
+        return 0 <= seq and self._sequence[seq % self.capacity] == seq
+
+    def get(self, seq):
+        """Returns a view of frame `seq`, or None once it has been overwritten."""
+        if not self.valid(seq):
+            return None
+        return self.frames[seq % self.capacity]
+
+    def latest(self):
+        if self.count == 0:
+            return None
+        return self.get(self.count - 1)
+
+    def pin(self, seq):
+        with self._cond:
+            if not self.valid(seq):
+                return False
+            self._pins[seq % self.capacity] += 1
+            return True
+
+    def release(self, seq):
+        with self._cond:
+            slot = seq % self.capacity
+            if self._sequence[slot] == seq and self._pins[slot] > 0:
+                self._pins[slot] -= 1
+                self._cond.notify_all()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Incremental stacking of the frames of one series step. A FrameStacker keeps a
+running float64 sum and sum of squares of every frame it is given, which is all
+the co-added frame, the mean and the standard deviation need, plus per-pixel
+Welford running means and variances of the samples that survive a streaming sigma
+clip: once a pixel has `min_samples` accepted samples, a new sample further than
+`clip` standard deviations from its running mean is rejected (cosmic rays, hot
+readouts). Memory use is a handful of float64 frames however many frames are
+stacked, so long dark and flat sequences can be reduced without keeping, or even
+saving, the individual frames.
+
+save() writes the stack as an uncompressed .npz file holding the arrays sum, mean,
+std, clipped_mean, clipped_std and clipped_count, and the frame count.
+"""
+
+import os
+
+import numpy as np
+
+
+class FrameStacker(object):
+    def __init__(self, shape, clip = 3.0, min_samples = 10):
+        self.shape = tuple(shape)
+        self.clip = clip
+        self.min_samples = min_samples
+        self.count = 0
+        self.sum = np.zeros(self.shape, dtype = np.float64)
+        self.sumsq = np.zeros(self.shape, dtype = np.float64)
+        # Welford state of the samples kept by the sigma clip
+        self.clipped_count = np.zeros(self.shape, dtype = np.int64)
+        self._mean = np.zeros(self.shape, dtype = np.float64)
+        self._m2 = np.zeros(self.shape, dtype = np.float64)
+        # Scratch frames, so adding a frame allocates nothing
+        self._x = np.empty(self.shape, dtype = np.float64)
+        self._delta = np.empty(self.shape, dtype = np.float64)
+        self._accept = np.empty(self.shape, dtype = bool)
+
+    def add(self, img):
+        x, delta, accept = self._x, self._delta, self._accept
+        np.copyto(x, img, casting = 'unsafe')
+        self.sum += x
+        np.multiply(x, x, out = delta)
+        self.sumsq += delta
+        self.count += 1
+
+        np.subtract(x, self._mean, out = delta)
+        if self.clip is None or self.count <= self.min_samples:
+            accept[...] = True
+        else:
+            # |x - mean| <= clip * std  <=>  (x - mean)^2 * (n - 1) <= clip^2 * M2
+            np.multiply(delta, delta, out = x)
+            x *= np.maximum(self.clipped_count - 1, 1)
+            np.less_equal(x, self.clip ** 2 * self._m2, out = accept)
+            # Too few samples kept to judge a pixel: take the sample
+            accept |= self.clipped_count < self.min_samples
+        self.clipped_count += accept
+        delta *= accept
+        # For accepted samples mean += delta / n and M2 += delta * (x - new mean),
+        # where x - new mean = delta - delta / n
+        np.divide(delta, self.clipped_count, out = x)
+        self._mean += x
+        np.subtract(delta, x, out = x)
+        x *= delta
+        self._m2 += x
+        return self.count
+
+    def mean(self):
+        return self.sum / max(self.count, 1)
+
+    def variance(self):
+        # Sample variance from the running sums
+        if self.count < 2:
+            return np.zeros(self.shape)
+        mean = self.mean()
+        return np.maximum(self.sumsq / self.count - mean * mean, 0) * (self.count / (self.count - 1))
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def clipped_mean(self):
+        return self._mean.copy()
+
+    def clipped_variance(self):
+        return self._m2 / np.maximum(self.clipped_count - 1, 1)
+
+    def rejected(self):
+        """Number of samples the sigma clip rejected, over all pixels."""
+        return int(self.count * self.sum.size - self.clipped_count.sum())
+
+    def save(self, path, **meta):
+        # Write under a temporary name so a crash never leaves a truncated stack
+        with open(path + '.part', 'wb') as f:
+            np.savez(f, sum = self.sum, mean = self.mean(), std = self.std(),
+                     clipped_mean = self._mean, clipped_std = np.sqrt(self.clipped_variance()),
+                     clipped_count = self.clipped_count, frames = self.count, **meta)
+        os.replace(path + '.part', path)
+        return path
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Live statistics of camera frames. frame_statistics() reduces a uint16 frame, or a
+region of interest of it, to one np.bincount histogram in a single pass and reads
+the count, mean, standard deviation, median, minimum, maximum and number of
+saturated pixels off that histogram (about 3 ms for a full 1024x1024 frame).
+
+A FrameStats is fed every frame by the acquisition engine but only computes the
+statistics of a frame every `interval` seconds. Each result is kept in a
+preallocated history of the last `history` results, and the latest one has a
+coarse histogram of the bulk of the pixel values for plotting.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+# Fractions of the pixels below the first and last histogram bins
+HISTOGRAMRANGE = (0.0005, 0.9995)
+
+FIELDS = ('time', 'mean', 'std', 'median', 'min', 'max', 'saturated')
+
+
+def frame_statistics(img, roi = None, saturation = 65535, bins = 128):
+    """
+    Statistics of `img` inside `roi` = (x0, x1, y0, y1), half-open pixel bounds, or of
+    the whole frame. 'histogram' holds `bins` counts of the values between 'edges'[0]
+    and 'edges'[-1], the 0.05 and 99.95 percentiles.
+    """
+    if roi is not None:
+        x0, x1, y0, y1 = roi
+        img = img[y0:y1, x0:x1]
+    if img.dtype.kind != 'u' or img.dtype.itemsize > 2:
+        img = np.clip(img, 0, 65535).astype(np.uint16)
+    counts = np.bincount(img.ravel())
+    n = img.size
+    if n == 0:
+        return None
+    values = np.arange(len(counts), dtype = np.float64)
+    occupied = np.flatnonzero(counts)
+    low, high = int(occupied[0]), int(occupied[-1])
+    mean = counts @ values / n
+    variance = max(counts @ (values * values) / n - mean * mean, 0.0)
+    cumulative = np.cumsum(counts)
+    median = int(np.searchsorted(cumulative, (n + 1) / 2))
+    saturated = int(counts[saturation:].sum()) if saturation < len(counts) else 0
+    # Merge the bulk of the full histogram into `bins` equal bins; the range leaves out
+    # the few hot or dead pixels that would otherwise squeeze everything into one bin
+    first, last = np.searchsorted(cumulative, (HISTOGRAMRANGE[0] * n, HISTOGRAMRANGE[1] * n))
+    last = min(int(last), high)
+    bins = min(bins, last - first + 1)
+    edges = np.linspace(first, last + 1, bins + 1).astype(np.int64)
+    histogram = np.add.reduceat(counts[first:last + 1], edges[:-1] - first)
+    return {
+        'count': n, 'mean': float(mean), 'std': float(np.sqrt(variance)), 'median': median,
+        'min': low, 'max': high, 'saturated': saturated,
+        'histogram': histogram, 'edges': edges,
+    }
+
+
+class FrameStats(object):
+    def __init__(self, interval = 0.2, history = 600, roi = None, saturation = 65535):
+        self.interval = interval
+        self.roi = roi
+        self.saturation = saturation
+        self.latest = None
+        self.elapsed = 0.0
+        self._history = np.full((history, len(FIELDS)), np.nan)
+        self._count = 0
+        self._next = 0.0
+        self._shape = None
+        self._lock = threading.Lock()
+
+    def set_roi(self, roi):
+        with self._lock:
+            self.roi = roi
+            self._reset()
+
+    def _reset(self):
+        # Statistics of different regions or frame shapes don't belong in one history
+        self._history[:] = np.nan
+        self._count = 0
+        self._next = 0.0
+
+    def offer(self, img):
+        """Computes the statistics of `img` if `interval` has passed since the last ones."""
+        if img.shape != self._shape:
+            with self._lock:
+                self._shape = img.shape
+                self._reset()
+        now = time.monotonic()
+        if now < self._next:
+            return False
+        self._next = now + self.interval
+        start = time.perf_counter()
+        stats = frame_statistics(img, self.roi, self.saturation)
+        if stats is None:
+            return False
+        stats['time'] = time.time()
+        self.elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._history[self._count % len(self._history)] = [stats[field] for field in FIELDS]
+            self._count += 1
+            self.latest = stats
+        return True
+
+    def history(self, field = None):
+        """History rows oldest first, as a (n, len(FIELDS)) array or one column of it."""
+        with self._lock:
+            n = min(self._count, len(self._history))
+            rows = self._history[np.arange(self._count - n, self._count) % len(self._history)]
+        return rows if field is None else rows[:, FIELDS.index(field)]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Per-frame hot-path instrumentation. A StageTimer keeps, for the last `capacity`
+frames, a perf_counter() timestamp at the start of the frame and after each stage
+in one preallocated array. Summaries give rolling per-stage means and percentiles
+and the raw timestamps can be exported to CSV. While disabled, start(), mark() and
+end() return after a single attribute check. peak_rss_mb() gives the peak memory
+of the process, for the benchmark and the headless runner.
+"""
+
+import csv
+import sys
+
+import numpy as np
+from time import perf_counter
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+class StageTimer(object):
+    def __init__(self, stages, capacity = 4096, enabled = False):
+        self.stages = tuple(stages)
+        self.capacity = capacity
+        self.enabled = enabled
+        # Column 0 is the frame start, column i the end of stage i
+        self._times = np.full((capacity, len(self.stages) + 1), np.nan)
+        self._row = None
+        self.count = 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._row = self._times[self.count % self.capacity]
+        self._row[:] = np.nan
+        self._row[0] = perf_counter()
+
+    def mark(self, stage):
+        # `stage` is the position of the stage in self.stages
+        if self._row is not None:
+            self._row[stage + 1] = perf_counter()
+
+    def end(self):
+        if self._row is not None:
+            self._row = None
+            self.count += 1
+
+    def reset(self):
+        self._times[:] = np.nan
+        self._row = None
+        self.count = 0
+
+    def timestamps(self, last = None):
+        # Rows of the recorded frames, oldest first
+        n = min(self.count, self.capacity)
+        if last is not None:
+            n = min(n, last)
+        rows = np.arange(self.count - n, self.count) % self.capacity
+        return self._times[rows]
+
+    def durations(self, last = None):
+        """Stage durations in ms; a skipped stage is NaN."""
+        times = self.timestamps(last)
+        # A stage lasts from the latest earlier timestamp to its own
+        previous = np.fmax.accumulate(times[:, :-1], axis = 1)
+        return (times[:, 1:] - previous) * 1000
+
+    def summary(self, last = 500):
+        durations = self.durations(last)
+        result = {}
+        for i, stage in enumerate(self.stages):
+            values = durations[:, i]
+            values = values[~np.isnan(values)]
+            if len(values):
+                result[stage] = {
+                    'mean': float(values.mean()),
+                    'p50': float(np.percentile(values, 50)),
+                    'p99': float(np.percentile(values, 99)),
+                }
+        return result
+
+    def summary_text(self, last = 500):
+        lines = [f"{stage}: {s['mean']:.2f} / {s['p50']:.2f} / {s['p99']:.2f} ms"
+                 for stage, s in self.summary(last).items()]
+        return "\n".join(lines)
+
+    def export_csv(self, path):
+        times = self.timestamps()
+        with open(path, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame', 'start'] + list(self.stages))
+            for i, row in enumerate(times, start = self.count - len(times)):
+                writer.writerow([i] + ['' if np.isnan(t) else f"{t:.6f}" for t in row])
+        return len(times)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Background writer stage for the camera GUI. The acquisition loops hand every frame
+to a FrameWriter, which keeps it in a bounded queue and saves it from one or more
+worker threads, so compressing and writing a frame never delays the next
+cam1.wait_for_frame(). Compression can optionally be moved into worker processes.
+The writer reports its queue depth, throughput and the number of dropped frames.
+
+Every submitted frame gets the next sequence number of the session, which goes into
+its filename together with a microsecond timestamp, so no two frames can share a
+file. A SessionManifest records one JSON line per frame (sequence number, target,
+exposure, temperature, file and byte offset) so frames can be found later without
+listing the image folder.
+"""
+
+import collections
+import datetime
+import json
+import os
+import queue
+import itertools
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from Codecs import frame_bytes, get_codec
+
+
+# Append-only JSON-lines record of every frame saved during one GUI session
+class SessionManifest(object):
+    def __init__(self, folder):
+        current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        self.path = os.path.join(folder, f"session_{current_time}.manifest.jsonl")
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._file = open(self.path, 'a')
+
+    def next_sequence(self):
+        with self._lock:
+            seq = self._sequence
+            self._sequence += 1
+            return seq
+
+    def record(self, **entry):
+        line = json.dumps(entry, default = str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# Saves every frame as its own <target>_<timestamp>_<sequence> file, encoded with a codec from Codecs.py
+class FileSink(object):
+    def __init__(self, folder, codec = 'npz'):
+        self.folder = folder
+        self.codec = get_codec(codec)
+
+    def encode(self, img):
+        return frame_bytes(img, self.codec)
+
+    def write(self, payload, meta):
+        current_time = meta['time'].strftime("%Y-%m-%d_%H-%M-%S-%f")
+        filename = f"{meta['target']}_{current_time}_{meta['seq']:06d}{self.codec.extension}"
+        file_path = os.path.join(self.folder, filename)
+        # Write under a temporary name so a crash never leaves a truncated frame file
+        with open(file_path + '.part', 'wb') as f:
+            f.write(payload)
+        os.replace(file_path + '.part', file_path)
+        return file_path, 0
+
+    def finish(self, container):
+        pass
+
+    def close(self):
+        pass
+
+
+class FrameWriter(object):
+    """
+    Bounded queue of frames saved by `num_workers` threads through `sink`.
+
+    `sink` provides encode(img) -> payload, write(payload, meta) -> (file path,
+    byte offset), finish(container) and close(). With
+    `use_processes` the encode step runs in a process pool, so the sink must be
+    picklable. When the queue is full, submit() waits up to `block_timeout`
+    seconds for a free slot and then drops the frame. `on_done`, if given, is
+    called once the writer no longer needs `img` (saved, failed or dropped), which
+    lets frames be submitted as views into a FrameRingBuffer. `on_saved(file_path)`
+    is called from the worker thread after the frame has been written. Frames are
+    numbered by `manifest` and recorded in it when one is given, otherwise by a
+    counter private to this writer.
+    """
+    def __init__(self, sink, num_workers = 2, max_queue = 32, use_processes = False,
+                 block_timeout = 1.0, manifest = None):
+        self.sink = sink
+        self.manifest = manifest
+        self._sequence = itertools.count()
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.block_timeout = block_timeout
+
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._pool = ProcessPoolExecutor(num_workers) if use_processes else None
+
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.raw_bytes = 0
+        self._recent = collections.deque()
+
+        self._workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target = self._work, name = f"FrameWriter-{i}", daemon = True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, img, target, on_done = None, on_saved = None, **meta):
+        meta['target'] = target
+        meta.setdefault('time', datetime.datetime.now())
+        if self.manifest is not None:
+            meta['seq'] = self.manifest.next_sequence()
+        else:
+            meta['seq'] = next(self._sequence)
+        with self._lock:
+            if self._closed:
+                self.dropped += 1
+                dropped = True
+            else:
+                self.submitted += 1
+                dropped = False
+        if not dropped:
+            try:
+                self._queue.put(('frame', img, meta, on_done, on_saved), timeout = self.block_timeout)
+                return True
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+        self._record(meta, None, None)
+        if on_done is not None:
+            on_done()
+        return False
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            if item[0] == 'finish':
+                self._finish(item[1])
+                continue
+            self._save(*item[1:])
+
+    def _finish(self, container):
+        try:
+            self.sink.finish(container)
+        except Exception as e:
+            print(f"Error while finishing {container}: {e}")
+        finally:
+            self._queue.task_done()
+
+    def _save(self, img, meta, on_done, on_saved):
+        try:
+            if self._pool is not None:
+                payload = self._pool.submit(self.sink.encode, img).result()
+            else:
+                payload = self.sink.encode(img)
+            file_path, offset = self.sink.write(payload, meta)
+            self._record(meta, file_path, offset)
+            if on_saved is not None:
+                on_saved(file_path)
+        except Exception as e:
+            print(f"Error while saving frame: {e}")
+            with self._lock:
+                self.failed += 1
+        else:
+            with self._lock:
+                self.written += 1
+                self.raw_bytes += img.nbytes
+                self._recent.append((time.perf_counter(), img.nbytes))
+        finally:
+            if on_done is not None:
+                on_done()
+            self._queue.task_done()
+
+    def _record(self, meta, file_path, offset):
+        if self.manifest is None:
+            return
+        # A frame without a file was dropped; its sequence number still shows the gap
+        self.manifest.record(seq = meta['seq'], time = meta['time'].isoformat(),
+                             target = meta['target'], exposure = meta.get('exposure'),
+                             temperature = meta.get('temperature'),
+                             file = file_path and os.path.basename(file_path),
+                             offset = offset)
+
+    def flush(self):
+        self._queue.join()
+
+    def finish(self, container, wait = True):
+        """
+        Lets the sink finalize `container` once the frames queued before this call are
+        saved. With wait=False this only queues the request; it then runs in order
+        only when the writer has a single worker, as used for cubes.
+        """
+        if wait:
+            self.flush()
+            self.sink.finish(container)
+        else:
+            self._queue.put(('finish', container))
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.flush()
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+        self.sink.close()
+
+    def stats(self, window = 5.0):
+        now = time.perf_counter()
+        with self._lock:
+            while self._recent and self._recent[0][0] < now - window:
+                self._recent.popleft()
+            frames = len(self._recent)
+            nbytes = sum(n for t, n in self._recent)
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_queue': self.max_queue,
+                'submitted': self.submitted,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'frames_per_s': frames / window,
+                'mb_per_s': nbytes / window / 1e6,
+            }
+
+    def status_text(self):
+        s = self.stats()
+        return (f"Writer: queue {s['queue_depth']}/{s['max_queue']}, "
+                f"{s['frames_per_s']:.1f} frames/s, {s['mb_per_s']:.1f} MB/s, "
+                f"dropped {s['dropped']}")
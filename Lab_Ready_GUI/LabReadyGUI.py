@@ -6,87 +6,147 @@ Description:
 This script launches a GUI written with PyQt5 used to operate a PIXIS 1024 camera.
 Users are able to change image capture parameters and take images using either a 
 continuous capture loop or a pre-determined capture series.
+
+Start it with --simulate to use the simulated camera from SimulatedCamera.py
+instead of the PIXIS, e.g. for testing on a machine without the camera. --serial
+and --dll select the camera and the PICam runtime. The window opens right away and
+the camera is connected in the background; matplotlib is only loaded once its view
+is selected.
 """
 
+import time
+STARTTIME = time.perf_counter()
+
 from PyQt5 import QtCore, QtWidgets
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-import matplotlib.pyplot as plt
 import numpy as np
-import threading
-import time
-import matplotlib
+import argparse
 import datetime
 import sys
 import os
+import threading
 from PyQt5.QtCore import QThread, pyqtSignal
-import pylablib as pll
-from pylablib.devices import PrincetonInstruments
+from FrameWriter import FrameWriter, FileSink, SessionManifest
+from FrameBuffer import FrameRingBuffer
+from SeriesJournal import SeriesJournal, find_unfinished
+from SeriesPlan import SeriesError, compile_series
+from CubeFile import CubeSink
+from Codecs import CODECCHOICES
+from FastImageView import FastImageView, HistogramView, RateCounter
+from DisplayThrottle import DisplayThrottle
+from DisplayScaling import DisplayScaling
+from FrameStats import FrameStats
+from AcquisitionEngine import AcquisitionEngine
+from FrameTimings import StageTimer
+from Telemetry import TelemetryPoller
+from TemperatureMonitor import TemperatureMonitor
+from CameraConnection import open_camera, check_roi
+from CalibrationLibrary import CalibrationLibrary
 
+# Overridden by the --output option; created if it does not exist
 PATHTOIMAGEFOLDER = "C:\\Users\\hayde\\OneDrive\\Desktop\\images"
 
-# Initialize Camera
-pll.par["devices/dlls/picam"] = "C:\\Program Files\\Princeton Instruments\\PICam\\Runtime\\Picam.dll"
+# Background writer settings
+WRITERWORKERS = 2
+WRITERQUEUESIZE = 32
+WRITERPROCESSES = False
+
+# Storage format: 'npz' saves one file per frame, 'cube' appends frames to one file per series
+SAVEFORMAT = 'npz'
+
+# Codec for one-file-per-frame saving, see Codecs.py (run it to benchmark the choices)
+FRAMECODEC = 'npz'
 
-# List available cameras and initialize one
-print(PrincetonInstruments.list_cameras())
+# Live view: 'fast' paints frames through a colormap lookup table, 'matplotlib' uses imshow
+DISPLAYMODE = 'fast'
 
-# Initialize the camera with a valid serial number 
-cam1 = PrincetonInstruments.PicamCamera('0809080002')
+# Highest live view refresh rate; newer frames replace ones that were not shown yet
+DISPLAYMAXRATE = 20
 
-# Set camera attributes, e.g., exposure time
-cam1.set_attribute_value('Exposure Time', 10)
+# Live view contrast: 'minmax', 'percentile', 'zscale' or 'fixed', computed from every
+# SCALESTRIDE-th row and column and smoothed over frames (weight of the newest frame)
+SCALEMODE = 'percentile'
+SCALEPERCENTILES = (0.5, 99.5)
+SCALESTRIDE = 4
+SCALESMOOTHING = 0.3
 
-# Eliminate Extra Figure
-matplotlib.use('Qt5Agg')
-plt.ioff()
+# Frame statistics: seconds between updates and number of updates kept in the history
+STATSINTERVAL = 0.2
+STATSHISTORY = 300
+
+# Number of frames held in the preallocated ring buffer (2 MB each at 1024x1024)
+RINGBUFFERFRAMES = 64
+
+# Readout: batched mode drains every waiting frame in one driver call; the camera buffer
+# holds this many frames between reads (short exposures need a bigger buffer), at most
+# RINGBUFFERFRAMES
+BATCHEDREADOUT = False
+BUFFERFRAMES = 64
+
+# Sigma clip of stacked series steps ('stack' or 'stack-only' after the target name)
+STACKCLIPSIGMA = 3.0
+
+# Master darks and biases; frames can be saved raw or with the master subtracted
+CALIBRATIONFOLDER = "calibration"  # inside PATHTOIMAGEFOLDER
+CALIBRATIONCACHE = 8
+CALIBRATESAVED = False
+
+# Camera status polling interval and the age after which a cached reading counts as unknown (s)
+TELEMETRYINTERVAL = 0.5
+TELEMETRYMAXAGE = 5.0
+
+# The sensor is stable once it holds within the tolerance (deg C) of the set point for the
+# dwell time (s); with WAITFORSTABLE, live capture and series wait for that instead of
+# being disabled until the sensor is ready
+TEMPERATURETOLERANCE = 2.0
+TEMPERATUREDWELL = 30.0
+WAITFORSTABLE = True
+
+# Camera, overridden by the --serial, --dll and --simulate options
+CAMERASERIAL = '0809080002'
+PICAMDLL = "C:\\Program Files\\Princeton Instruments\\PICam\\Runtime\\Picam.dll"
+SIMULATE = False
+INITIALEXPOSURE = 10
 
 muteerrors = True
 
-# Series Capture Thread
-class CaptureSeriesThread(QThread):
-    update_image = pyqtSignal(np.ndarray)
+# Runs the acquisition engine in its own thread and forwards its status through a signal
+class EngineThread(QThread):
+    status = pyqtSignal(str)
 
-    def __init__(self, series, parent=None):
+    def __init__(self, engine, parent=None):
         super().__init__(parent)
-        self.series = series
+        self.engine = engine
+        self.engine.status = self.status.emit
 
     def run(self):
-        for command in self.series:
-            if len(command) == 1:
-                time.sleep(command[0]/1000)
-            else:
-                num_exposures, exposure_time, target_name = command
-                Images = []
-                cam1.set_attribute_value('Exposure Time', int(exposure_time))
-                cam1.start_acquisition()
-                while True:
-                    if len(Images) < num_exposures:
-                        # Image Capture
-                        cam1.wait_for_frame()
-                        img = cam1.read_oldest_image()
-                        Images.append(img)
-                        self.update_image.emit(img)
-                        if exposure_time < 1000:
-                            current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                            filename = f"{target_name}_{current_time}"    
-                            file_path = os.path.join(PATHTOIMAGEFOLDER, filename)
-                            np.savez_compressed(file_path, array = img)
-                    else:
-                        break
-                cam1.stop_acquisition()
-                if exposure_time >= 1000:
-                    for img in Images:
-                        current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                        filename = f"{target_name}_{current_time}"    
-                        file_path = os.path.join(PATHTOIMAGEFOLDER, filename)
-                        np.savez_compressed(file_path, array = img)
-                        
+        self.engine.run()
+
+
+# Opens the camera off the GUI thread, since connecting takes seconds or can fail
+class ConnectThread(QThread):
+    connected = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def run(self):
+        try:
+            cam = open_camera(CAMERASERIAL, PICAMDLL, SIMULATE, INITIALEXPOSURE)
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.connected.emit(cam)
+
+
+# Delivers telemetry changes and sensor stability changes from the polling thread to the GUI thread
+class TelemetrySignals(QtCore.QObject):
+    changed = pyqtSignal(str, object)
+    stability = pyqtSignal(str)
+
 
 class Ui_Form(object):
     def setupUi(self, Form):
         self.Form = Form
         Form.setObjectName("Form")
-        Form.resize(1200, 1000)
+        Form.resize(1500, 1000)
 
         self.stop = False
         self.cam_open = True
@@ -95,6 +155,40 @@ class Ui_Form(object):
 
         self.CurrentTempSetPoint = -70
         
+        # Background Frame Writer
+        os.makedirs(PATHTOIMAGEFOLDER, exist_ok=True)
+        self.saveFormat = SAVEFORMAT
+        self.frameCodec = FRAMECODEC
+        self.manifest = SessionManifest(PATHTOIMAGEFOLDER)
+        self.writer = self.makeWriter()
+        
+        # Preallocated Frame Buffer
+        self.frames = FrameRingBuffer(RINGBUFFERFRAMES)
+        
+        # Acquisition Engine, the only user of the camera once it is connected
+        self.engine = AcquisitionEngine(None, self.writer, self.frames)
+        self.engine.stack_clip = STACKCLIPSIGMA
+        self.calibration = CalibrationLibrary(os.path.join(PATHTOIMAGEFOLDER, CALIBRATIONFOLDER),
+                                              CALIBRATIONCACHE)
+        self.mastersBuilt = False
+        
+        # Camera Telemetry, polled off the GUI thread
+        self.telemetrySignals = TelemetrySignals(Form)
+        self.telemetry = TelemetryPoller(self.engine.get_attribute,
+                                         interval=TELEMETRYINTERVAL,
+                                         on_change=self.telemetrySignals.changed.emit,
+                                         on_read=self.feedTemperature,
+                                         exists=self.engine.has_attribute)
+        self.telemetrySignals.changed.connect(self.TempStatus)
+        
+        # Sensor Temperature Stabilization, judged on the telemetry thread
+        self.temperature = TemperatureMonitor(tolerance=TEMPERATURETOLERANCE, dwell=TEMPERATUREDWELL,
+                                              on_change=self.telemetrySignals.stability.emit)
+        self.engine.temperature = self.temperature
+        self.engine.wait_stable = WAITFORSTABLE
+        self.telemetrySignals.stability.connect(self.updateCameraStatus)
+        self.telemetrySignals.changed.connect(self.updateCameraStatus)
+        
         # Parameters Label
         self.Pt = QtWidgets.QLabel(Form)
         self.Pt.setGeometry(QtCore.QRect(35, 10, 130, 30))
@@ -153,6 +247,13 @@ class Ui_Form(object):
         self.Param.setText("add delay 3000\n5 1200 HeNe_darks_1200ms")
         self.Param.setStyleSheet("font-size: 14px;")
         
+        # Series Plan Check, redone on every edit
+        self.PS = QtWidgets.QLabel(Form)
+        self.PS.setGeometry(QtCore.QRect(35, 787, 310, 20))
+        self.PS.setObjectName("PS")
+        self.PS.setStyleSheet("font-size: 12px;")
+        self.Param.textChanged.connect(self.checkSeries)
+        
         # Example Series
         self.ExmplS = QtWidgets.QPushButton(Form)
         self.ExmplS.setGeometry(QtCore.QRect(35, 810, 140, 60))
@@ -242,6 +343,35 @@ class Ui_Form(object):
         self.Temp.setText("Temperature (°C):")
         self.Temp.setStyleSheet("font-size: 16px;")  
         
+        # Region of Interest Label and Field, in sensor pixels: x0 x1 y0 y1 (ends exclusive)
+        self.RoiLabel = QtWidgets.QLabel(Form)
+        self.RoiLabel.setGeometry(QtCore.QRect(495, 160, 110, 20))
+        self.RoiLabel.setObjectName("RoiLabel")
+        self.RoiLabel.setText("Sensor ROI:")
+        self.RoiLabel.setStyleSheet("font-size: 16px;")
+        
+        self.Roi = QtWidgets.QLineEdit(Form)
+        self.Roi.setGeometry(QtCore.QRect(495, 190, 115, 30))
+        self.Roi.setObjectName("Roi")
+        self.Roi.setPlaceholderText("x0 x1 y0 y1")
+        self.Roi.setToolTip("Columns x0-x1 and rows y0-y1 to read out; empty reads the full sensor")
+        self.Roi.setStyleSheet("font-size: 14px;")
+        
+        # Binning Label and Field, horizontal x vertical
+        self.BinLabel = QtWidgets.QLabel(Form)
+        self.BinLabel.setGeometry(QtCore.QRect(770, 160, 75, 20))
+        self.BinLabel.setObjectName("BinLabel")
+        self.BinLabel.setText("Binning:")
+        self.BinLabel.setStyleSheet("font-size: 16px;")
+        
+        self.Binning = QtWidgets.QLineEdit(Form)
+        self.Binning.setGeometry(QtCore.QRect(770, 190, 65, 30))
+        self.Binning.setObjectName("Binning")
+        self.Binning.setText("1x1")
+        self.Binning.setToolTip("Horizontal x vertical binning, e.g. 1x8 to sum rows")
+        self.Binning.setStyleSheet("font-size: 14px;")
+        self.detectorSize = None
+        
         # Target Status
         self.TGS = QtWidgets.QLabel(Form)
         self.TGS.setGeometry(QtCore.QRect(115, 100, 120, 16))
@@ -265,14 +395,55 @@ class Ui_Form(object):
         
         # Camera Status Label
         self.CG = QtWidgets.QLabel(Form)
-        self.CG.setGeometry(QtCore.QRect(840, 10, 300, 25))
+        self.CG.setGeometry(QtCore.QRect(840, 3, 300, 40))
         self.CG.setObjectName("CG")
+        self.CG.setWordWrap(True)
+        self.connected = False
+        self.connectFailed = False
+        self.connectStatus = "Connecting to camera…"
         self.updateCameraStatus()
         
+        # Reconnect Button, shown when connecting failed
+        self.Reconnect = QtWidgets.QPushButton(Form)
+        self.Reconnect.setGeometry(QtCore.QRect(1150, 8, 110, 30))
+        self.Reconnect.setObjectName("Reconnect")
+        self.Reconnect.setText("Reconnect")
+        self.Reconnect.setStyleSheet("font-size: 14px;")
+        self.Reconnect.setVisible(False)
+        self.Reconnect.clicked.connect(self.connectCamera)
+        
+        # Save Format Selection
+        self.SaveFmt = QtWidgets.QComboBox(Form)
+        self.SaveFmt.setGeometry(QtCore.QRect(35, 250, 170, 30))
+        self.SaveFmt.setObjectName("SaveFmt")
+        self.SaveFmt.addItem("One file per frame", 'npz')
+        self.SaveFmt.addItem("One .cube per series", 'cube')
+        self.SaveFmt.setCurrentIndex(self.SaveFmt.findData(self.saveFormat))
+        self.SaveFmt.setStyleSheet("font-size: 14px;")
+        self.SaveFmt.currentIndexChanged.connect(self.setSaveFormat)
+        
+        # Codec Selection
+        self.Codec = QtWidgets.QComboBox(Form)
+        self.Codec.setGeometry(QtCore.QRect(215, 250, 200, 30))
+        self.Codec.setObjectName("Codec")
+        self.Codec.addItems(CODECCHOICES)
+        self.Codec.setCurrentText(self.frameCodec)
+        self.Codec.setStyleSheet("font-size: 14px;")
+        self.Codec.setEnabled(self.saveFormat == 'npz')
+        self.Codec.currentIndexChanged.connect(self.setSaveFormat)
+        
+        # Writer Status
+        self.WS = QtWidgets.QLabel(Form)
+        self.WS.setGeometry(QtCore.QRect(35, 900, 310, 60))
+        self.WS.setObjectName("WS")
+        self.WS.setWordWrap(True)
+        self.WS.setStyleSheet("font-size: 12px;")
+        self.WriterStatus()
+        
         # Timer for live Updates
         self.timer = QtCore.QTimer(Form)
-        self.timer.timeout.connect(self.updateCameraStatus)
         self.timer.timeout.connect(self.TempStatus)
+        self.timer.timeout.connect(self.WriterStatus)
         self.timer.start(500)
         
         # Graph
@@ -286,145 +457,603 @@ class Ui_Form(object):
         self.ID.setText("Image Display")
         self.ID.setStyleSheet("font-size: 24px;")
 
-        self.figure = plt.figure()
-        self.ax = self.figure.add_subplot(111) 
-        self.canvas = FigureCanvas(self.figure)
-        self.graphLayout.addWidget(self.canvas)        
-        self.figure.set_facecolor('#F0F0F0')
+        # The matplotlib view is only built once it is selected, see makeCanvas
+        self.canvas = None
+        self.plotRate = RateCounter()
+        
+        # Fast Image Display
+        self.fastView = FastImageView(cmap='Blues')
+        self.graphLayout.addWidget(self.fastView)
+        
+        # Display Mode Selection
+        self.displayMode = DISPLAYMODE
+        self.DispMode = QtWidgets.QComboBox(Form)
+        self.DispMode.setGeometry(QtCore.QRect(850, 290, 170, 30))
+        self.DispMode.setObjectName("DispMode")
+        self.DispMode.addItem("Fast (QImage)", 'fast')
+        self.DispMode.addItem("Matplotlib", 'matplotlib')
+        self.DispMode.setCurrentIndex(self.DispMode.findData(self.displayMode))
+        self.DispMode.setStyleSheet("font-size: 14px;")
+        self.DispMode.currentIndexChanged.connect(self.setDisplayMode)
+        self.setDisplayMode()
+        
+        # Display Frame Rate
+        self.FPS = QtWidgets.QLabel(Form)
+        self.FPS.setGeometry(QtCore.QRect(850, 325, 260, 20))
+        self.FPS.setObjectName("FPS")
+        self.FPS.setStyleSheet("font-size: 14px;")
+        self.timer.timeout.connect(self.DisplayRate)
+        
+        # Display Throttling
+        self.throttle = DisplayThrottle(self.display_image, DISPLAYMAXRATE, Form)
+        self.MaxFps = QtWidgets.QSpinBox(Form)
+        self.MaxFps.setGeometry(QtCore.QRect(1030, 290, 60, 30))
+        self.MaxFps.setObjectName("MaxFps")
+        self.MaxFps.setRange(1, 100)
+        self.MaxFps.setValue(DISPLAYMAXRATE)
+        self.MaxFps.setSuffix(" fps")
+        self.MaxFps.setStyleSheet("font-size: 14px;")
+        self.MaxFps.valueChanged.connect(self.throttle.set_max_rate)
         
-        # Plot appearance
-        self.ax.set_xlabel("X-axis")
-        self.ax.set_ylabel("Y-axis")
         self.stopButton.clicked.connect(self.stopFunction)
         self.setValues.clicked.connect(self.setFunction)
         
+        # Display Scaling
+        self.scaling = DisplayScaling(SCALEMODE, *SCALEPERCENTILES, stride=SCALESTRIDE,
+                                      smoothing=SCALESMOOTHING)
+        self.ScaleMode = QtWidgets.QComboBox(Form)
+        self.ScaleMode.setGeometry(QtCore.QRect(1130, 160, 170, 30))
+        self.ScaleMode.setObjectName("ScaleMode")
+        self.ScaleMode.addItem("Min/max", 'minmax')
+        self.ScaleMode.addItem(f"Percentile {SCALEPERCENTILES[0]:g}-{SCALEPERCENTILES[1]:g}", 'percentile')
+        self.ScaleMode.addItem("Zscale", 'zscale')
+        self.ScaleMode.addItem("Fixed", 'fixed')
+        self.ScaleMode.setCurrentIndex(self.ScaleMode.findData(SCALEMODE))
+        self.ScaleMode.setStyleSheet("font-size: 14px;")
+        self.ScaleMode.currentIndexChanged.connect(self.setScaling)
+        
+        self.ScaleMin = QtWidgets.QSpinBox(Form)
+        self.ScaleMin.setGeometry(QtCore.QRect(1130, 195, 80, 30))
+        self.ScaleMin.setObjectName("ScaleMin")
+        self.ScaleMax = QtWidgets.QSpinBox(Form)
+        self.ScaleMax.setGeometry(QtCore.QRect(1220, 195, 80, 30))
+        self.ScaleMax.setObjectName("ScaleMax")
+        for spin, value in ((self.ScaleMin, 0), (self.ScaleMax, 65535)):
+            spin.setRange(0, 65535)
+            spin.setValue(value)
+            spin.setStyleSheet("font-size: 14px;")
+            spin.valueChanged.connect(self.setScaling)
+        self.setScaling()
+        
+        # Frame Statistics, computed by the engine thread
+        self.stats = FrameStats(STATSINTERVAL, STATSHISTORY)
+        self.engine.stats = self.stats
+        self.StatsTitle = QtWidgets.QLabel(Form)
+        self.StatsTitle.setGeometry(QtCore.QRect(1100, 255, 250, 30))
+        self.StatsTitle.setObjectName("StatsTitle")
+        self.StatsTitle.setText("Frame Statistics")
+        self.StatsTitle.setStyleSheet("font-size: 18px;")
+        
+        self.SS = QtWidgets.QLabel(Form)
+        self.SS.setGeometry(QtCore.QRect(1100, 290, 380, 95))
+        self.SS.setObjectName("SS")
+        self.SS.setAlignment(QtCore.Qt.AlignTop)
+        self.SS.setStyleSheet("font-size: 12px; font-family: monospace;")
+        
+        self.Histogram = HistogramView(Form)
+        self.Histogram.setGeometry(QtCore.QRect(1100, 390, 380, 110))
+        self.Histogram.setObjectName("Histogram")
+        
+        self.StatsRoi = QtWidgets.QLineEdit(Form)
+        self.StatsRoi.setGeometry(QtCore.QRect(1100, 510, 300, 28))
+        self.StatsRoi.setObjectName("StatsRoi")
+        self.StatsRoi.setPlaceholderText("ROI x0 x1 y0 y1 (empty: full frame)")
+        self.StatsRoi.setStyleSheet("font-size: 12px;")
+        self.StatsRoi.editingFinished.connect(self.setStatsRoi)
+        self.timer.timeout.connect(self.StatsStatus)
+        
+        # Frame Timing Instrumentation
+        self.displayTimings = StageTimer(('scale', 'render'))
+        self.TimingBox = QtWidgets.QCheckBox(Form)
+        self.TimingBox.setGeometry(QtCore.QRect(1080, 560, 200, 25))
+        self.TimingBox.setObjectName("TimingBox")
+        self.TimingBox.setText("Record frame timings")
+        self.TimingBox.setStyleSheet("font-size: 14px;")
+        self.TimingBox.toggled.connect(self.enableTimings)
+        
+        self.TS = QtWidgets.QLabel(Form)
+        self.TS.setGeometry(QtCore.QRect(1080, 590, 400, 150))
+        self.TS.setObjectName("TS")
+        self.TS.setAlignment(QtCore.Qt.AlignTop)
+        self.TS.setStyleSheet("font-size: 12px; font-family: monospace;")
+        self.timer.timeout.connect(self.TimingStatus)
+        
+        self.ExportTimings = QtWidgets.QPushButton(Form)
+        self.ExportTimings.setGeometry(QtCore.QRect(1080, 745, 150, 30))
+        self.ExportTimings.setObjectName("ExportTimings")
+        self.ExportTimings.setText("Export Timings")
+        self.ExportTimings.setStyleSheet("font-size: 14px;")
+        self.ExportTimings.clicked.connect(self.exportTimings)
+        
+        # Camera Readout
+        self.engine.set_readout(batched=BATCHEDREADOUT, buffer_frames=BUFFERFRAMES)
+        self.Batched = QtWidgets.QCheckBox(Form)
+        self.Batched.setGeometry(QtCore.QRect(1080, 800, 200, 25))
+        self.Batched.setObjectName("Batched")
+        self.Batched.setText("Batched readout")
+        self.Batched.setChecked(BATCHEDREADOUT)
+        self.Batched.setStyleSheet("font-size: 14px;")
+        self.Batched.toggled.connect(self.setReadout)
+        
+        self.BufferFrames = QtWidgets.QSpinBox(Form)
+        self.BufferFrames.setGeometry(QtCore.QRect(1080, 830, 150, 30))
+        self.BufferFrames.setObjectName("BufferFrames")
+        self.BufferFrames.setRange(1, RINGBUFFERFRAMES)
+        self.BufferFrames.setValue(BUFFERFRAMES)
+        self.BufferFrames.setPrefix("Buffer: ")
+        self.BufferFrames.setSuffix(" frames")
+        self.BufferFrames.setStyleSheet("font-size: 14px;")
+        self.BufferFrames.valueChanged.connect(self.setReadout)
+        
+        self.RS = QtWidgets.QLabel(Form)
+        self.RS.setGeometry(QtCore.QRect(1080, 865, 400, 20))
+        self.RS.setObjectName("RS")
+        self.RS.setStyleSheet("font-size: 12px;")
+        self.timer.timeout.connect(self.ReadoutStatus)
+        
+        # Calibration
+        self.Calibrate = QtWidgets.QCheckBox(Form)
+        self.Calibrate.setGeometry(QtCore.QRect(1080, 895, 200, 25))
+        self.Calibrate.setObjectName("Calibrate")
+        self.Calibrate.setText("Subtract master dark")
+        self.Calibrate.setStyleSheet("font-size: 14px;")
+        self.Calibrate.toggled.connect(self.setCalibration)
+        
+        self.CalibrateSaved = QtWidgets.QCheckBox(Form)
+        self.CalibrateSaved.setGeometry(QtCore.QRect(1290, 895, 190, 25))
+        self.CalibrateSaved.setObjectName("CalibrateSaved")
+        self.CalibrateSaved.setText("Also before saving")
+        self.CalibrateSaved.setChecked(CALIBRATESAVED)
+        self.CalibrateSaved.setStyleSheet("font-size: 14px;")
+        self.CalibrateSaved.toggled.connect(self.setCalibration)
+        
+        self.BuildMasters = QtWidgets.QPushButton(Form)
+        self.BuildMasters.setGeometry(QtCore.QRect(1080, 925, 150, 30))
+        self.BuildMasters.setObjectName("BuildMasters")
+        self.BuildMasters.setText("Build Masters…")
+        self.BuildMasters.setStyleSheet("font-size: 14px;")
+        self.BuildMasters.clicked.connect(self.buildMasters)
+        
+        self.calibrationStatus = f"{len(self.calibration.entries)} masters in the library"
+        self.CS = QtWidgets.QLabel(Form)
+        self.CS.setGeometry(QtCore.QRect(1240, 925, 250, 50))
+        self.CS.setObjectName("CS")
+        self.CS.setWordWrap(True)
+        self.CS.setStyleSheet("font-size: 12px;")
+        self.timer.timeout.connect(self.CalibrationStatus)
+        
+        # Engine Status
+        self.ES = QtWidgets.QLabel(Form)
+        self.ES.setGeometry(QtCore.QRect(35, 875, 310, 20))
+        self.ES.setObjectName("ES")
+        self.ES.setText("Paused")
+        self.ES.setStyleSheet("font-size: 12px;")
 
-        # Start the image capture thread
-        self.capture_thread = threading.Thread(target=self.capture_images)
-        self.capture_thread.start()
+        # The acquisition engine thread starts once the camera is connected
+        self.engine.display = self.throttle.offer
+        self.engineThread = EngineThread(self.engine)
+        # Journal of the series handed to the engine, until the engine reports it ended
+        self.activeJournal = None
+        self.engineThread.status.connect(self.EngineStatus)
+        self.connectThread = ConnectThread(Form)
+        self.connectThread.connected.connect(self.cameraConnected)
+        self.connectThread.failed.connect(self.cameraFailed)
+        self.connectCamera()
+        QtCore.QTimer.singleShot(0, lambda: print(
+            f"Startup: window shown after {time.perf_counter() - STARTTIME:.2f} s"))
         
         self.retranslateUi(Form)
         QtCore.QMetaObject.connectSlotsByName(Form)
 
+    def connectCamera(self):
+        self.connectStatus = "Connecting to camera…"
+        self.connectFailed = False
+        self.Reconnect.setVisible(False)
+        self.updateCameraStatus()
+        self.connectThread.start()
+        
+    def cameraConnected(self, cam):
+        if not self.cam_open:
+            # The window was closed while connecting
+            cam.close()
+            return
+        print(f"Startup: camera connected after {time.perf_counter() - STARTTIME:.2f} s")
+        self.engine.cam = cam
+        self.engine.get_attribute('Exposure Time')
+        self.temperature.watch(self.engine.get_attribute('Sensor Temperature Set Point'))
+        self.engine.get_attribute('Readout Time Calculation')
+        self.detectorSize = cam.get_detector_size()
+        self.Roi.setPlaceholderText(f"0 {self.detectorSize[0]} 0 {self.detectorSize[1]}")
+        self.connected = True
+        self.checkSeries()
+        self.telemetry.start()
+        self.engineThread.start()
+        self.updateCameraStatus()
+        
+    def cameraFailed(self, error):
+        self.connectStatus = f"Camera connection failed: {error}"
+        self.connectFailed = True
+        print(self.connectStatus)
+        self.Reconnect.setVisible(True)
+        self.updateCameraStatus()
+        
     def stopFunction(self):
         if muteerrors == True:
             sys.stderr = open(os.devnull, 'w')
         self.Form.close()
         self.cam_open = False
-        cam1.close()
+        self.connectThread.wait()
+        self.telemetry.stop()
+        # The engine closes the camera once the frame in progress is done
+        self.engine.stop()
+        self.engineThread.wait()
         self.stop = True
+        # Save every frame still waiting in the writer queue
+        self.writer.close()
+        self.manifest.close()
         
-    def updateCameraStatus(self):
+    def updateCameraStatus(self, *changed):
         self.CG.clear()
-        if self.cam_open == True:
-            if (self.CurrentTempSetPoint -2)  < cam1.get_attribute_value('Sensor Temperature Reading') < (self.CurrentTempSetPoint + 2):
+        if not self.connected:
+            self.CG.setText(self.connectStatus)
+            self.CG.setStyleSheet(("color: red;" if self.connectFailed else "color: orange;")
+                                  + " font-size: 14px;")
+            self.resumeButton.setEnabled(False)
+            self.Cap2.setEnabled(False)
+        elif self.cam_open == True:
+            reading = self.telemetry.get('Sensor Temperature Reading', max_age=TELEMETRYMAXAGE)
+            if reading is None:
+                self.CG.setText("Waiting for camera status")
+                self.CG.setStyleSheet("color: orange; font-size: 14px;")
+                self.resumeButton.setEnabled(False)
+                self.Cap2.setEnabled(False)
+            elif self.temperature.stable.is_set():
                 self.CG.setText("Camera is ready for Image Capture")
                 self.CG.setStyleSheet("color: green; font-size: 14px;")
-                self.resumeButton.setEnabled(True)
-                self.Cap2.setEnabled(True)
+                self.resumeButton.setEnabled(self.paused)
+                self.Cap2.setEnabled(self.activeJournal is None)
             else:
-                self.CG.setText("Camera is not ready for Image Capture")
-                self.CG.setStyleSheet("color: red; font-size: 14px;")
-                self.resumeButton.setEnabled(False)
-                self.Cap2.setEnabled(False)
+                # Capture started now waits in the engine until the sensor is stable
+                self.CG.setText(self.temperature.describe())
+                self.CG.setStyleSheet(("color: orange;" if WAITFORSTABLE else "color: red;")
+                                      + " font-size: 14px;")
+                self.resumeButton.setEnabled(WAITFORSTABLE and self.paused)
+                self.Cap2.setEnabled(WAITFORSTABLE and self.activeJournal is None)
 
     
-    def TempStatus(self):
-        self.TmpS.setText(str(cam1.get_attribute_value('Sensor Temperature Reading')))
+    def feedTemperature(self, name, value):
+        # Called on the telemetry thread with every reading
+        if name == 'Sensor Temperature Reading':
+            self.temperature.update(value)
+    
+    def TempStatus(self, *changed):
+        reading = self.telemetry.get('Sensor Temperature Reading', max_age=TELEMETRYMAXAGE)
+        self.TmpS.setText('--' if reading is None else str(reading))
+        
+    def makeWriter(self):
+        if self.saveFormat == 'cube':
+            # Cube appends are plain sequential writes; one worker keeps frames in order
+            return FrameWriter(CubeSink(PATHTOIMAGEFOLDER), num_workers=1,
+                               max_queue=WRITERQUEUESIZE, manifest=self.manifest)
+        return FrameWriter(FileSink(PATHTOIMAGEFOLDER, self.frameCodec),
+                           num_workers=WRITERWORKERS,
+                           max_queue=WRITERQUEUESIZE,
+                           use_processes=WRITERPROCESSES,
+                           manifest=self.manifest)
+    
+    def setSaveFormat(self):
+        if self.engine.state != 'idle':
+            # The engine may be submitting to the writer; put the choice back until it is idle
+            for box, value in ((self.SaveFmt, self.SaveFmt.findData(self.saveFormat)),
+                               (self.Codec, self.Codec.findText(self.frameCodec))):
+                box.blockSignals(True)
+                box.setCurrentIndex(value)
+                box.blockSignals(False)
+            self.updateSaveControls()
+            return
+        old_writer = self.writer
+        self.saveFormat = self.SaveFmt.currentData()
+        self.frameCodec = self.Codec.currentText()
+        self.updateSaveControls()
+        self.writer = self.makeWriter()
+        self.engine.writer = self.writer
+        old_writer.close()
+        
+    def updateSaveControls(self):
+        # The writer can only be swapped while the engine is idle
+        idle = self.engine.state == 'idle'
+        self.SaveFmt.setEnabled(idle)
+        self.Codec.setEnabled(idle and self.saveFormat == 'npz')
         
+    def WriterStatus(self):
+        self.WS.setText(f"{self.writer.status_text()}, ring buffer overruns {self.frames.overruns}")
+        
+    def readRoi(self):
+        # The ROI and binning fields as (hstart, hend, vstart, vend, hbin, vbin)
+        width, height = self.detectorSize
+        parts = self.Roi.text().split()
+        if not parts:
+            parts = [0, width, 0, height]
+        if len(parts) != 4:
+            raise ValueError("Enter the ROI as four numbers: x0 x1 y0 y1")
+        binning = self.Binning.text().lower().replace('x', ' ').split() or [1, 1]
+        if len(binning) != 2:
+            raise ValueError("Enter the binning as horizontal x vertical, e.g. 1x8")
+        roi = tuple(int(p) for p in parts) + tuple(int(b) for b in binning)
+        check_roi(roi, self.detectorSize)
+        return roi
+    
     def setFunction(self):
+        roi = None
+        if self.detectorSize is not None:
+            try:
+                roi = self.readRoi()
+            except ValueError as e:
+                QtWidgets.QMessageBox.warning(self.Form, "Region of Interest", str(e))
+                return
+        
         self.TGS.setText(str(self.Target.text()))
         self.ExpS.setText(str(self.Exposure.value()))
         self.CurrentTempSetPoint = self.Temperature.value()
         self.CurrentTempSetPoint = self.Temperature.value()
         self.Tempsetstatus.setText(str(self.CurrentTempSetPoint))
         
-        cam1.set_attribute_value('Exposure Time', self.Exposure.value())
-        cam1.set_attribute_value('Sensor Temperature Set Point', self.Temperature.value())
-        print(cam1.get_attribute_value('Sensor Temperature Set Point'))
-        print(cam1.get_attribute_value('Sensor Temperature Reading'))
+        self.engine.set_target(self.TGS.text())
+        self.engine.set_attributes(Exposure_Time=self.Exposure.value(),
+                                   Sensor_Temperature_Set_Point=self.Temperature.value())
+        self.temperature.watch(self.Temperature.value())
+        if roi is not None and roi != self.engine.roi:
+            self.engine.set_roi(*roi)
 
     
-    def capture_images(self):
-        if not hasattr(self, 'image_handle'):
-            initial_image = np.zeros((1024,1024))
-            self.image_handle = self.ax.imshow(initial_image, 
-                                               interpolation='nearest', 
-                                               cmap='Blues',
-                                               vmin=0)
-            self.canvas.draw_idle()
-            
-        while self.cam_open:
-            if self.paused:
-                time.sleep(0.1) 
-                continue
-        
-            try:
-                cam1.start_acquisition()
-                while True:
-                    if not self.paused:
-                        cam1.wait_for_frame()
-                        image = cam1.read_oldest_image()
-                        self.image_handle.set_data(image)
-                        self.image_handle.set_clim(0,np.max(image))
-                        self.canvas.draw_idle()
-                    else:
-                        break
-                    target_name = self.TGS.text()
-                    current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                    filename = f"{target_name}_{current_time}"    
-                    file_path = os.path.join(PATHTOIMAGEFOLDER, filename)
-                    np.savez_compressed(file_path, array = image)
-        
-                cam1.stop_acquisition()
-            except Exception as e:
-                print(f"Error during capture: {e}")
-                break
-
-
     def pauseCapture(self):
         self.paused = True
+        self.engine.pause()
         self.pauseButton.setEnabled(False)
         self.resumeButton.setEnabled(True)
         
+    def frameShape(self):
+        # Shape of the frames the camera reads with the current ROI and binning
+        if self.engine.roi is not None:
+            hstart, hend, vstart, vend, hbin, vbin = self.engine.roi
+            return (vend - vstart) // vbin, (hend - hstart) // hbin
+        if self.detectorSize is not None:
+            return self.detectorSize[1], self.detectorSize[0]
+        return self.frames.shape
+    
+    def checkSeries(self):
+        try:
+            plan = compile_series(self.Param.toPlainText())
+        except SeriesError as e:
+            self.PS.setText(str(e))
+            self.PS.setStyleSheet("color: red; font-size: 12px;")
+            return None
+        self.PS.setText(plan.summary(self.engine.attributes.get('Readout Time Calculation') or 0,
+                                     self.frameShape()))
+        self.PS.setStyleSheet("font-size: 12px;")
+        return plan
+    
+    def EngineStatus(self, text):
+        self.ES.setText(text)
+        self.updateSaveControls()
+        if text in ("Series finished", "Series interrupted"):
+            self.activeJournal = None
+            self.updateCameraStatus()
+    
     def ExecuteSeries(self):
-        input_string = self.Param.toPlainText()
-        series = []
+        if self.activeJournal is not None:
+            # The engine ignores a second series, and its journal must not be offered for resuming
+            QtWidgets.QMessageBox.information(self.Form, "Series", "A series is already running.")
+            return
+        # Every line is checked before anything runs
+        plan = self.checkSeries()
+        if plan is None:
+            QtWidgets.QMessageBox.warning(self.Form, "Series", self.PS.text())
+            return
     
-        rows = input_string.splitlines()
-        for row in rows:
-            parts = row.split()
-            if not parts:
-                continue
+        journal = self.resumableJournal()
+        if journal is None:
+            journal = SeriesJournal.create(PATHTOIMAGEFOLDER, plan)
     
-            if parts[0] == 'add' and parts[1] == 'delay':
-                series.append([float(parts[2])])
-            else:
-                num_exposures = int(parts[0])
-                exposure_time = float(parts[1])
-                file_name = parts[2]
-                series.append([num_exposures, exposure_time, file_name])
+        self.activeJournal = journal
+        self.updateCameraStatus()
+        self.engine.series(journal)
     
-        # Create and start the thread
-        self.capture_thread = CaptureSeriesThread(series)
-        self.capture_thread.update_image.connect(self.display_image)
-        self.capture_thread.start()
+    def resumableJournal(self):
+        # Offer to resume series that were interrupted by a crash or a closed GUI
+        for path in find_unfinished(PATHTOIMAGEFOLDER):
+            if self.activeJournal is not None and path == self.activeJournal.path:
+                continue
+            journal = SeriesJournal.load(path)
+            saved, total = journal.progress()
+            answer = QtWidgets.QMessageBox.question(
+                self.Form, "Interrupted Series",
+                f"{os.path.basename(path)} stopped after {saved} of {total} frames.\n"
+                "Resume it instead of starting the new series?")
+            if answer == QtWidgets.QMessageBox.Yes:
+                return journal
+            journal.finish(status='abandoned')
+        return None
     
     def ExampleSeries(self):
-        self.Param.setText("add delay 3000n 5 1200 HeNe_Darks_1200_ms")
+        self.Param.setText("wait temperature -70 ±2\n"
+                           "repeat 2 {\n"
+                           "    5 200..1200:500 HeNe_Darks_${exposure}ms_$i\n"
+                           "}")
     
     def display_image(self, img):
-        if not hasattr(self, 'image_handle'):
-            self.image_handle = self.ax.imshow(img, interpolation='nearest')
+        self.displayTimings.start()
+        vmin, vmax = self.scaling.limits(img)
+        self.displayTimings.mark(0)
+        if self.displayMode == 'fast':
+            self.fastView.set_image(img, vmin, vmax)
         else:
+            if img.shape != self.image_handle.get_array().shape:
+                # A new ROI or binning: fit the axes to the new frame shape
+                rows, cols = img.shape
+                self.image_handle.set_extent((-0.5, cols - 0.5, rows - 0.5, -0.5))
+                self.ax.set_xlim(-0.5, cols - 0.5)
+                self.ax.set_ylim(rows - 0.5, -0.5)
             self.image_handle.set_data(img)
-            self.image_handle.set_clim(0,np.max(img))
+            self.image_handle.set_clim(vmin, vmax)
+            self.canvas.draw_idle()
+        self.displayTimings.mark(1)
+        self.displayTimings.end()
     
+    def enableTimings(self, enabled):
+        self.engine.timings.enabled = enabled
+        self.displayTimings.enabled = enabled
+        
+    def TimingStatus(self):
+        if self.TimingBox.isChecked():
+            self.TS.setText("stage: mean / p50 / p99\n"
+                            + self.engine.timings.summary_text() + "\n"
+                            + self.displayTimings.summary_text())
+            
+    def exportTimings(self):
+        current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        for name, timings in (('acquisition', self.engine.timings), ('display', self.displayTimings)):
+            file_path = os.path.join(PATHTOIMAGEFOLDER, f"timings_{name}_{current_time}.csv")
+            timings.export_csv(file_path)
+            print(f"Saved {file_path}")
+    
+    def setReadout(self):
+        # The buffer size applies from the next start of live capture or a series step
+        self.engine.set_readout(batched=self.Batched.isChecked(),
+                                buffer_frames=self.BufferFrames.value())
+        
+    def ReadoutStatus(self):
+        engine = self.engine
+        if engine.batches:
+            self.RS.setText(f"{engine.batched_frames / engine.batches:.1f} frames per batched read")
+        
+    def makeCanvas(self):
+        # matplotlib takes about half a second to import, so it waits until it is needed
+        import matplotlib
+        matplotlib.use('Qt5Agg')
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        
+        # Eliminate Extra Figure
+        plt.ioff()
+        self.figure = plt.figure()
+        self.ax = self.figure.add_subplot(111) 
+        self.canvas = FigureCanvas(self.figure)
+        self.graphLayout.addWidget(self.canvas)        
+        self.figure.set_facecolor('#F0F0F0')
+        self.canvas.mpl_connect('draw_event', lambda event: self.plotRate.tick())
+        
+        # Plot appearance
+        self.ax.set_xlabel("X-axis")
+        self.ax.set_ylabel("Y-axis")
+        
+        initial_image = np.zeros(self.frames.shape)
+        self.image_handle = self.ax.imshow(initial_image, 
+                                           interpolation='nearest', 
+                                           cmap='Blues',
+                                           vmin=0)
         self.canvas.draw_idle()
+        
+    def setStatsRoi(self):
+        parts = self.StatsRoi.text().split()
+        if not parts:
+            self.stats.set_roi(None)
+            return
+        try:
+            x0, x1, y0, y1 = (int(p) for p in parts)
+        except ValueError:
+            self.SS.setText("ROI needs four whole numbers: x0 x1 y0 y1")
+            return
+        if not (0 <= x0 < x1 and 0 <= y0 < y1):
+            self.SS.setText("ROI needs x0 < x1 and y0 < y1")
+            return
+        self.stats.set_roi((x0, x1, y0, y1))
+        
+    def StatsStatus(self):
+        stats = self.stats.latest
+        if stats is None:
+            return
+        means = self.stats.history('mean')
+        self.SS.setText(
+            f"Mean {stats['mean']:.1f} ± {stats['std']:.1f}   Median {stats['median']}\n"
+            f"Min {stats['min']}   Max {stats['max']}   Saturated {stats['saturated']}\n"
+            f"Last {len(means)} updates: mean {np.mean(means):.1f} "
+            f"({np.min(means):.1f} to {np.max(means):.1f})\n"
+            f"{stats['count']} pixels in {self.stats.elapsed:.1f} ms")
+        self.Histogram.set_histogram(stats['histogram'], stats['edges'])
+        
+    def setScaling(self):
+        fixed = self.ScaleMode.currentData() == 'fixed'
+        self.ScaleMin.setEnabled(fixed)
+        self.ScaleMax.setEnabled(fixed)
+        self.scaling.set_fixed(self.ScaleMin.value(), self.ScaleMax.value())
+        if self.ScaleMode.currentData() != self.scaling.mode:
+            self.scaling.set_mode(self.ScaleMode.currentData())
+        
+    def setCalibration(self):
+        # Attribute assignments, picked up by the engine with the next frame
+        self.engine.calibrate_saved = self.CalibrateSaved.isChecked()
+        self.engine.calibration = self.calibration if self.Calibrate.isChecked() else None
+        
+    def buildMasters(self):
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(
+            self.Form, "Dark or Bias Series", PATHTOIMAGEFOLDER, "Series journals (*.journal)")
+        if not path:
+            return
+        # Only for journals that don't record the set point of their frames, before any
+        # 'wait temperature' step of the series
+        set_point = self.engine.attributes.get('Sensor Temperature Set Point', self.CurrentTempSetPoint)
+        self.calibrationStatus = f"Building masters from {os.path.basename(path)}…"
+        self.BuildMasters.setEnabled(False)
+        
+        # Loading and stacking the frames takes a while; keep it off the GUI thread
+        def build():
+            try:
+                entries = self.calibration.build_from_journal(path, set_point)
+                self.calibrationStatus = "Built " + ", ".join(e['file'] for e in entries)
+            except Exception as e:
+                self.calibrationStatus = f"Building masters failed: {e}"
+            self.mastersBuilt = True
+        threading.Thread(target=build, daemon=True).start()
+        
+    def CalibrationStatus(self):
+        if self.mastersBuilt:
+            self.mastersBuilt = False
+            self.BuildMasters.setEnabled(True)
+        text = self.calibrationStatus
+        if self.engine.calibration is not None:
+            entry = self.calibration.find(self.engine.attributes.get('Exposure Time'),
+                                          self.engine.attributes.get('Sensor Temperature Set Point'))
+            text = (f"Subtracting {entry['file']} ({entry['frames']} frames)" if entry is not None
+                    else "No master for this exposure and set point")
+        self.CS.setText(text)
+        
+    def setDisplayMode(self):
+        self.displayMode = self.DispMode.currentData()
+        if self.displayMode == 'matplotlib' and self.canvas is None:
+            self.makeCanvas()
+        if self.canvas is not None:
+            self.canvas.setVisible(self.displayMode == 'matplotlib')
+        self.fastView.setVisible(self.displayMode == 'fast')
+        
+    def DisplayRate(self):
+        rate = self.fastView.rate if self.displayMode == 'fast' else self.plotRate
+        self.FPS.setText(f"Display: {rate.rate:.1f} fps, skipped {self.throttle.skipped}")
     
 
     def resumeCapture(self):
         self.paused = False
+        self.engine.live()
         self.resumeButton.setEnabled(False)
         self.pauseButton.setEnabled(True)
         
@@ -434,8 +1063,20 @@ class Ui_Form(object):
 
         
 if __name__ == "__main__":
-    import sys
-    app = QtWidgets.QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Operate a PIXIS 1024 camera.")
+    parser.add_argument('--serial', default=CAMERASERIAL,
+                        help="camera serial number; an empty string opens the first camera found")
+    parser.add_argument('--dll', default=PICAMDLL, help="path of Picam.dll")
+    parser.add_argument('--simulate', action='store_true', help="use the simulated camera")
+    parser.add_argument('--output', default=PATHTOIMAGEFOLDER,
+                        help="folder for the frames, journals and calibration masters")
+    args, qt_args = parser.parse_known_args()
+    CAMERASERIAL = args.serial or None
+    PICAMDLL = args.dll
+    SIMULATE = args.simulate
+    PATHTOIMAGEFOLDER = args.output
+    
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
     Form = QtWidgets.QWidget()
     ui = Ui_Form()
     ui.setupUi(Form)
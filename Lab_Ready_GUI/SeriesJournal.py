@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Crash-safe progress journal for capture series. Every series writes a small
+JSON-lines file next to its images: the series itself when it starts, one line for
+every frame once the writer has saved it, one line for every finished delay and a
+final line when the series ends. Each line is flushed and synced to disk, so after
+a crash the journal tells exactly which frames are on disk and the series can be
+resumed from where it stopped.
+
+A stacked series step also gets a line for its stack; for a stack-only step, whose
+frames are never saved on their own, that line is what marks the frames as done.
+A series compiled from text is journaled as its text, not as its expanded steps,
+and compiled again when the journal is loaded. Frame and stack lines carry the
+sensor set point they were taken at, when it is known, for building masters.
+"""
+
+import datetime
+import glob
+import json
+import os
+import threading
+
+from SeriesPlan import compile_series, step_kind
+
+
+class SeriesJournal(object):
+    def __init__(self, path, series, saved = None, delays_done = None, mode = 'a'):
+        self.path = path
+        self.series = series
+        self._saved = saved if saved is not None else {}
+        self._delays_done = delays_done if delays_done is not None else set()
+        self._lock = threading.Lock()
+        self._file = open(path, mode)
+
+    @classmethod
+    def create(cls, folder, series):
+        # Microseconds keep series started in the same second apart, and 'x' makes sure a
+        # new series never appends to the journal (and cube) of another
+        current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
+        path = os.path.join(folder, f"series_{current_time}.journal")
+        if hasattr(series, 'source'):
+            # A SeriesPlan expands its steps on demand
+            journal = cls(path, series, mode = 'x')
+            journal._record(event = 'begin', source = series.source, steps = len(series))
+        else:
+            journal = cls(path, [list(command) for command in series], mode = 'x')
+            journal._record(event = 'begin', series = journal.series)
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        series = []
+        saved = {}
+        delays_done = set()
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                if entry['event'] == 'begin':
+                    series = compile_series(entry['source']) if 'source' in entry else entry['series']
+                elif entry['event'] == 'frame':
+                    saved[entry['command']] = saved.get(entry['command'], 0) + 1
+                elif entry['event'] == 'stack' and entry.get('only'):
+                    saved[entry['command']] = saved.get(entry['command'], 0) + entry['frames']
+                elif entry['event'] == 'delay':
+                    delays_done.add(entry['command'])
+        return cls(path, series, saved, delays_done)
+
+    def _record(self, **entry):
+        entry['time'] = datetime.datetime.now().isoformat()
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def saved(self, index):
+        return self._saved.get(index, 0)
+
+    def is_done(self, index):
+        command = self.series[index]
+        if step_kind(command) != 'capture':
+            return index in self._delays_done
+        return self.saved(index) >= command[0]
+
+    def progress(self):
+        if hasattr(self.series, 'frames'):
+            total = self.series.frames
+        else:
+            total = sum(command[0] for command in self.series if step_kind(command) == 'capture')
+        saved = sum(self._saved.values())
+        return saved, total
+
+    def frame_saved(self, index, frame, file_path, set_point = None):
+        with self._lock:
+            self._saved[index] = self._saved.get(index, 0) + 1
+        self._record(event = 'frame', command = index, frame = frame, file = file_path,
+                     set_point = set_point)
+
+    def stack_saved(self, index, frames, file_path, only = False, set_point = None):
+        if only:
+            with self._lock:
+                self._saved[index] = self._saved.get(index, 0) + frames
+        self._record(event = 'stack', command = index, frames = frames, file = file_path, only = only,
+                     set_point = set_point)
+
+    def delay_done(self, index):
+        # Also marks a temperature wait as done
+        self._delays_done.add(index)
+        self._record(event = 'delay', command = index)
+
+    def finish(self, status = 'complete'):
+        self._record(event = 'end', status = status)
+        self._file.close()
+
+
+def find_unfinished(folder):
+    # Journals without an 'end' line belong to series that were interrupted
+    unfinished = []
+    for path in sorted(glob.glob(os.path.join(folder, "series_*.journal"))):
+        with open(path) as f:
+            lines = f.read().splitlines()
+        if not lines or '"event": "end"' not in lines[-1]:
+            unfinished.append(path)
+    return unfinished
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Compiler for the capture series text typed into the GUI. compile_series() checks
+every line before anything runs and turns the text into a SeriesPlan, a sequence
+of steps in the journal format used by SeriesJournal and AcquisitionEngine:
+
+    add delay <ms>                          ->  [ms]
+    wait temperature <set point> [±<tol>]   ->  ['temperature', set point, tol]
+    <count> <exposure ms> <target> [stack | stack-only]
+                                            ->  [count, exposure, target(, stacking)]
+
+On top of those lines the language has:
+
+    let <name> = <text>         a variable for target names
+    repeat <n> [as <name>] {    repeats the lines up to the matching '}' n times;
+    ...                         the repeat number (1..n) is in $<name>, $i by default
+    }
+
+An exposure can be a sweep, 'start..stop:step' (stop included) or a list 'a,b,c',
+which makes one step per exposure time. Target names can use $name or ${name} for
+variables, repeat numbers and $exposure, the exposure time of the step.
+
+Blank lines and anything after a '#' are ignored. A mistake raises a SeriesError
+that names the line, so a typo on line 40 is reported before the series starts
+instead of hours into it. Repeats and sweeps are not expanded when compiling: the
+plan computes any step from its index on demand, so a plan of a million steps
+takes no more memory than its text. A plan also estimates its duration and data
+volume.
+"""
+
+import bisect
+import math
+import re
+
+# Longest exposure accepted in a series, in ms
+MAXEXPOSURE = 24 * 3600 * 1000
+# Longest delay accepted in a series, in ms
+MAXDELAY = 24 * 3600 * 1000
+STACKING = ('stack', 'stack-only')
+# Characters a target name can't have, since it becomes part of file names
+BADTARGET = re.compile(r'[\\/:*?"<>|]')
+VARIABLE = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+NAME = re.compile(r'[A-Za-z_]\w*$')
+# Tolerance of a 'wait temperature' line without one, in deg C
+TEMPERATURETOLERANCE = 2.0
+# Most steps a single exposure sweep can make
+MAXSWEEP = 100000
+
+
+class SeriesError(ValueError):
+    def __init__(self, line, message):
+        super().__init__(f"Line {line}: {message}")
+        self.line = line
+
+
+def step_kind(step):
+    """'delay', 'temperature' or 'capture' for a step in the journal format."""
+    if len(step) == 1:
+        return 'delay'
+    if step[0] == 'temperature':
+        return 'temperature'
+    return 'capture'
+
+
+def format_exposure(exposure):
+    """Exact text of an exposure time in ms: '1000001', '0.5', never rounded like :g."""
+    exposure = float(exposure)
+    return str(int(exposure)) if exposure.is_integer() else repr(exposure)
+
+
+def _number(text, line, what, kind = float, signed = False):
+    try:
+        value = kind(text)
+    except ValueError:
+        raise SeriesError(line, f"{what} '{text}' is not a {'whole ' if kind is int else ''}number")
+    # nan and inf parse as floats but make no sense as times or temperatures
+    if not math.isfinite(value):
+        raise SeriesError(line, f"{what} '{text}' is not a finite number")
+    if value < 0 and not signed:
+        raise SeriesError(line, f"{what} can't be negative")
+    return value
+
+
+def _exposure(value, line):
+    if value > MAXEXPOSURE:
+        raise SeriesError(line, f"exposure time {value:g} ms is longer than {MAXEXPOSURE} ms")
+    return value
+
+
+class _Sweep(object):
+    # Exposure times of a capture line, computed from their index
+    def __init__(self, start, step = 0.0, count = 1, values = None):
+        self.start = start
+        self.step = step
+        self.values = values
+        self.count = len(values) if values is not None else count
+
+    def __getitem__(self, index):
+        if self.values is not None:
+            return self.values[index]
+        return round(self.start + index * self.step, 9)
+
+    def total(self):
+        if self.values is not None:
+            return sum(self.values)
+        return self.count * self.start + self.step * self.count * (self.count - 1) / 2
+
+
+def _parse_exposure(text, line):
+    if ',' in text:
+        values = tuple(_exposure(_number(value, line, "Exposure time"), line)
+                       for value in text.split(','))
+        return _Sweep(values[0], values = values)
+    if '..' not in text:
+        return _Sweep(_exposure(_number(text, line, "Exposure time"), line))
+    bounds, _, step = text.partition(':')
+    start, _, stop = bounds.partition('..')
+    start = _number(start, line, "Sweep start")
+    stop = _exposure(_number(stop, line, "Sweep end"), line)
+    if not step:
+        raise SeriesError(line, f"expected 'start..stop:step' for the exposure sweep '{text}'")
+    step = _number(step, line, "Sweep step")
+    if step == 0:
+        raise SeriesError(line, "the sweep step must be larger than 0")
+    if stop < start:
+        raise SeriesError(line, f"the sweep end {stop:g} ms is below its start {start:g} ms")
+    # The small margin keeps a stop that is a whole number of steps away despite rounding
+    count = int((stop - start) / step + 1e-9) + 1
+    if count > MAXSWEEP:
+        raise SeriesError(line, f"the sweep '{text}' makes {count} steps, more than {MAXSWEEP}")
+    return _Sweep(start, step, count)
+
+
+class _Capture(object):
+    def __init__(self, count, sweep, target, stacking, line):
+        self.count = count
+        self.sweep = sweep
+        # Target name with the 'let' variables already filled in
+        self.target = target
+        self.stacking = stacking
+        self.line = line
+        self.length = sweep.count
+        self.frames = count * sweep.count
+
+    def step(self, index, variables):
+        exposure = self.sweep[index]
+        target = self.target
+        if '$' in target:
+            values = dict(variables, exposure = format_exposure(exposure))
+            target = VARIABLE.sub(lambda match: values[match.group(1) or match.group(2)], target)
+        step = [self.count, exposure, target]
+        if self.stacking:
+            step.append(self.stacking)
+        return step
+
+    def seconds(self, readout_ms):
+        return (self.count * (self.sweep.total() + self.sweep.count * readout_ms)) / 1000
+
+
+class _Wait(object):
+    # A delay or a temperature gate: one step that takes no frames
+    frames = 0
+    length = 1
+
+    def __init__(self, step, line):
+        self._step = step
+        self.line = line
+
+    def step(self, index, variables):
+        return list(self._step)
+
+    def seconds(self, readout_ms):
+        # How long a temperature gate waits is not known in advance
+        return self._step[0] / 1000 if len(self._step) == 1 else 0.0
+
+
+class _Block(object):
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.starts = []
+        self.length = 0
+        for node in nodes:
+            self.starts.append(self.length)
+            self.length += node.length
+        self.frames = sum(node.frames for node in nodes)
+
+    def locate(self, index):
+        # (node, index inside the node) of a step
+        position = bisect.bisect_right(self.starts, index) - 1
+        return self.nodes[position], index - self.starts[position]
+
+    def step(self, index, variables):
+        node, index = self.locate(index)
+        return node.step(index, variables)
+
+    def steps(self, variables):
+        for node in self.nodes:
+            if isinstance(node, _Repeat):
+                yield from node.steps(variables)
+            else:
+                for index in range(node.length):
+                    yield node.step(index, variables)
+
+    def seconds(self, readout_ms):
+        return sum(node.seconds(readout_ms) for node in self.nodes)
+
+
+class _Repeat(object):
+    def __init__(self, count, name, body, line):
+        self.count = count
+        self.name = name
+        self.body = body
+        self.line = line
+        self.length = count * body.length
+        self.frames = count * body.frames
+
+    def step(self, index, variables):
+        repeat, index = divmod(index, self.body.length)
+        return self.body.step(index, dict(variables, **{self.name: str(repeat + 1)}))
+
+    def steps(self, variables):
+        for repeat in range(self.count):
+            yield from self.body.steps(dict(variables, **{self.name: str(repeat + 1)}))
+
+    def seconds(self, readout_ms):
+        return self.count * self.body.seconds(readout_ms)
+
+
+def _substitute(target, scopes, line):
+    # Fills in the 'let' variables; repeat numbers and the exposure are left for later
+    def replace(match):
+        name = match.group(1) or match.group(2)
+        for scope in reversed(scopes):
+            if name in scope:
+                return match.group(0) if scope[name] is None else scope[name]
+        if name == 'exposure':
+            return match.group(0)
+        raise SeriesError(line, f"unknown variable '${name}' in target name '{target}'")
+    return VARIABLE.sub(replace, target)
+
+
+def _parse_line(tokens, line, scopes):
+    if tokens[0] == 'add':
+        if len(tokens) != 3 or tokens[1] != 'delay':
+            raise SeriesError(line, "expected 'add delay <ms>'")
+        delay = _number(tokens[2], line, "Delay")
+        if delay > MAXDELAY:
+            raise SeriesError(line, f"delay {delay:g} ms is longer than {MAXDELAY} ms")
+        return _Wait([delay], line)
+    if tokens[0] == 'wait':
+        # '±0.5', '± 0.5' and '+-0.5' are all accepted
+        rest = ' '.join(tokens[2:]).replace('+-', '±').replace('±', ' ± ').split()
+        if len(tokens) < 3 or tokens[1] != 'temperature' or len(rest) not in (1, 3) \
+                or (len(rest) == 3 and rest[1] != '±'):
+            raise SeriesError(line, "expected 'wait temperature <set point> ±<tolerance>'")
+        set_point = _number(rest[0], line, "Set point", signed = True)
+        tolerance = _number(rest[2], line, "Tolerance") if len(rest) == 3 else TEMPERATURETOLERANCE
+        if tolerance == 0:
+            raise SeriesError(line, "the temperature tolerance must be larger than 0")
+        return _Wait(['temperature', set_point, tolerance], line)
+    if len(tokens) < 3:
+        raise SeriesError(line, "expected '<count> <exposure ms> <target>' or 'add delay <ms>'")
+    count = _number(tokens[0], line, "Frame count", int)
+    if count == 0:
+        raise SeriesError(line, "frame count must be at least 1")
+    sweep = _parse_exposure(tokens[1], line)
+    target = _substitute(tokens[2], scopes, line)
+    # Values filled in later are numbers, so checking the rest of the name is enough
+    if BADTARGET.search(VARIABLE.sub('', target)):
+        raise SeriesError(line, f"target name '{target}' can't contain any of \\ / : * ? \" < > |")
+    if len(tokens) == 3:
+        return _Capture(count, sweep, target, None, line)
+    if len(tokens) == 4 and tokens[3] in STACKING:
+        return _Capture(count, sweep, target, tokens[3], line)
+    raise SeriesError(line, f"unexpected '{' '.join(tokens[3:])}' after the target name "
+                            f"(only 'stack' or 'stack-only' may follow it)")
+
+
+def _parse_let(line, row):
+    text = row.split('#', 1)[0]
+    name, equals, value = text.strip()[len('let'):].partition('=')
+    name, value = name.strip(), value.strip()
+    if not equals or not NAME.match(name) or not value:
+        raise SeriesError(line, "expected 'let <name> = <text>'")
+    if name == 'exposure':
+        raise SeriesError(line, "'exposure' is the exposure time of a step and can't be set")
+    if BADTARGET.search(value) or '$' in value or len(value.split()) > 1:
+        raise SeriesError(line, f"the value of '{name}' must be one word without \\ / : * ? \" < > | $")
+    return name, value
+
+
+def _parse_repeat(tokens, line):
+    if tokens[-1] != '{' or len(tokens) not in (3, 5) or (len(tokens) == 5 and tokens[2] != 'as'):
+        raise SeriesError(line, "expected 'repeat <n> {' or 'repeat <n> as <name> {'")
+    count = _number(tokens[1], line, "Repeat count", int)
+    if count == 0:
+        raise SeriesError(line, "repeat count must be at least 1")
+    name = tokens[3] if len(tokens) == 5 else 'i'
+    if not NAME.match(name) or name == 'exposure':
+        raise SeriesError(line, f"'{name}' can't be the name of a repeat number")
+    return count, name
+
+
+def compile_series(text):
+    """Compiles series text into a SeriesPlan; raises SeriesError on the first bad line."""
+    # Blocks being parsed: (nodes, 'let' and repeat variables, repeat line, count, name)
+    stack = [([], {}, None, None, None)]
+    for line, row in enumerate(text.splitlines(), start = 1):
+        tokens = row.split('#', 1)[0].split()
+        if not tokens:
+            continue
+        nodes, scope = stack[-1][:2]
+        scopes = [block[1] for block in stack]
+        if tokens[0] == 'let':
+            name, value = _parse_let(line, row)
+            scope[name] = value
+        elif tokens[0] == 'repeat':
+            count, name = _parse_repeat(tokens, line)
+            # A repeat number is filled in when a step is expanded, so it has no value yet
+            stack.append(([], {name: None}, line, count, name))
+        elif tokens == ['}']:
+            if len(stack) == 1:
+                raise SeriesError(line, "'}' without a 'repeat' to close")
+            body, scope, start, count, name = stack.pop()
+            if not body:
+                raise SeriesError(start, "the repeat block is empty")
+            stack[-1][0].append(_Repeat(count, name, _Block(body), start))
+        else:
+            nodes.append(_parse_line(tokens, line, scopes))
+    if len(stack) > 1:
+        raise SeriesError(stack[-1][2], "the repeat block is not closed with '}'")
+    if not stack[0][0]:
+        raise SeriesError(1, "the series is empty")
+    return SeriesPlan(_Block(stack[0][0]), text)
+
+
+class SeriesPlan(object):
+    """
+    The steps of a compiled series. Indexing and iterating expand the steps as they
+    are asked for; `source` is the text the plan was compiled from.
+    """
+    def __init__(self, block, source):
+        self._block = block
+        self.source = source
+
+    def __len__(self):
+        return self._block.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("series step out of range")
+        return self._block.step(index, {})
+
+    def __iter__(self):
+        return self._block.steps({})
+
+    def line(self, index):
+        """Source line of the step at `index`."""
+        node = self._block
+        while not isinstance(node, (_Capture, _Wait)):
+            if isinstance(node, _Repeat):
+                node, index = node.body, index % node.body.length
+            else:
+                node, index = node.locate(index)
+        return node.line
+
+    @property
+    def frames(self):
+        return self._block.frames
+
+    def estimate(self, readout_ms = 0.0, frame_shape = (1024, 1024), overhead_ms = 50.0):
+        """
+        (seconds, bytes) the plan takes: every frame exposure + readout, every delay,
+        and `overhead_ms` to set up each capture step. Temperature waits count as 0 s.
+        Bytes are uncompressed uint16 frames, or float64 products for a stack.
+        """
+        pixels = frame_shape[0] * frame_shape[1]
+        seconds = self._block.seconds(readout_ms)
+        volume = 0
+        captures = 0
+        for node, repeats in self._captures(self._block, 1):
+            captures += repeats * node.length
+            if node.stacking != 'stack-only':
+                volume += repeats * node.frames * pixels * 2
+            if node.stacking:
+                # sum, mean, std, clipped mean, clipped std and clipped count
+                volume += repeats * node.length * 6 * pixels * 8
+        return seconds + captures * overhead_ms / 1000, volume
+
+    def _captures(self, block, repeats):
+        # (capture line, times it runs) for every capture line of the plan
+        for node in block.nodes:
+            if isinstance(node, _Repeat):
+                yield from self._captures(node.body, repeats * node.count)
+            elif isinstance(node, _Capture):
+                yield node, repeats
+
+    def summary(self, readout_ms = 0.0, frame_shape = (1024, 1024)):
+        seconds, volume = self.estimate(readout_ms, frame_shape)
+        minutes, seconds = divmod(round(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        duration = f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+        return (f"{len(self)} steps, {self.frames} frames, about {duration}, "
+                f"up to {volume / 1024 ** 2:.0f} MB")
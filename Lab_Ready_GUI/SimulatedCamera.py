@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Simulated PIXIS 1024 with the subset of the pylablib PicamCamera interface the GUI
+and the acquisition pipeline use, so everything can run and be benchmarked on a
+machine without the camera or the PICam runtime.
+
+Once started, the simulated camera produces a frame every exposure + readout time
+on a background thread and keeps it in a buffer of `buffer_frames` frames; when the
+reader falls behind, the oldest unread frame is overwritten and counted as an
+overrun, like the PICam buffer. The sensor temperature relaxes exponentially
+toward the set point with a small amount of noise. A region of interest and
+binning shrink the frames, and the readout time with them.
+"""
+
+import collections
+import threading
+import time
+
+import numpy as np
+
+
+def list_cameras():
+    return ["Simulated PIXIS 1024 (SIM0001)"]
+
+
+class SimulatedPicamCamera(object):
+    def __init__(self, serial = 'SIM0001', shape = (1024, 1024), readout_time = 0.1,
+                 buffer_frames = 100, ambient_temperature = 20.0, cooling_time = 30.0,
+                 dark_rate = 0.5, seed = 0):
+        self.serial = serial
+        self.shape = tuple(shape)
+        self.readout_time = readout_time
+        self.buffer_frames = buffer_frames
+        self.cooling_time = cooling_time
+        self.dark_rate = dark_rate
+        self.attributes = {
+            'Exposure Time': 10,
+            'Sensor Temperature Set Point': -70,
+            'Sensor Temperature Reading': ambient_temperature,
+            'Readout Time Calculation': readout_time * 1000,
+        }
+        self.acquired = 0
+        self.overruns = 0
+        self.full_readout_time = readout_time
+        self.roi = (0, self.shape[1], 0, self.shape[0], 1, 1)
+        self._rng = np.random.default_rng(seed)
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._acquiring = False
+        self._thread = None
+        self._temperature_time = time.monotonic()
+        # A few pregenerated noise frames keep frame production cheap
+        self._full_bank = [(600 + self._rng.normal(0, 8, self.shape)).astype(np.uint16) for i in range(4)]
+        self._bank = self._full_bank
+
+    # Attributes
+    def _update_temperature(self):
+        now = time.monotonic()
+        reading = self.attributes['Sensor Temperature Reading']
+        set_point = self.attributes['Sensor Temperature Set Point']
+        decay = np.exp(-(now - self._temperature_time) / self.cooling_time)
+        reading = set_point + (reading - set_point) * decay
+        self.attributes['Sensor Temperature Reading'] = reading
+        self._temperature_time = now
+
+    def get_all_attributes(self):
+        return dict(self.attributes)
+
+    def get_attribute_value(self, name):
+        if name == 'Sensor Temperature Reading':
+            self._update_temperature()
+            return round(self.attributes[name] + self._rng.normal(0, 0.05), 2)
+        return self.attributes[name]
+
+    def set_attribute_value(self, name, value):
+        if name == 'Sensor Temperature Set Point':
+            self._update_temperature()
+        if name == 'Sensor Temperature Reading':
+            raise ValueError("'Sensor Temperature Reading' is read-only")
+        self.attributes[name] = value
+
+    def get_detector_size(self):
+        return self.shape[1], self.shape[0]
+
+    def get_roi(self):
+        return self.roi
+
+    def set_roi(self, hstart = 0, hend = None, vstart = 0, vend = None, hbin = 1, vbin = 1):
+        width, height = self.get_detector_size()
+        hend = width if hend is None else hend
+        vend = height if vend is None else vend
+        # Like the driver, truncate the region to the sensor, at least one bin large
+        hbin, vbin = min(max(hbin, 1), width), min(max(vbin, 1), height)
+        hstart, vstart = min(max(hstart, 0), width - hbin), min(max(vstart, 0), height - vbin)
+        hend, vend = min(max(hend, hstart + hbin), width), min(max(vend, vstart + vbin), height)
+        # and drop the pixels that do not fill a whole bin
+        hend -= (hend - hstart) % hbin
+        vend -= (vend - vstart) % vbin
+        rows, cols = (vend - vstart) // vbin, (hend - hstart) // hbin
+        bank = []
+        for frame in self._full_bank:
+            binned = frame[vstart:vend, hstart:hend].reshape(rows, vbin, cols, hbin).sum(axis = (1, 3))
+            bank.append(np.minimum(binned, 65535).astype(np.uint16))
+        self._bank = bank
+        self.roi = (hstart, hend, vstart, vend, hbin, vbin)
+        # Readout time is mostly digitizing pixels, plus a share for shifting every row
+        pixels = rows * cols / (width * height)
+        self.readout_time = self.full_readout_time * (0.2 * (vend - vstart) / height + 0.8 * pixels)
+        self.attributes['Readout Time Calculation'] = self.readout_time * 1000
+        return self.roi
+
+    # Acquisition
+    def setup_acquisition(self, mode = 'sequence', nframes = 100):
+        self.buffer_frames = nframes
+
+    def acquisition_in_progress(self):
+        return self._acquiring
+
+    def start_acquisition(self, *args, **kwargs):
+        self.stop_acquisition()
+        if 'nframes' in kwargs:
+            self.buffer_frames = kwargs['nframes']
+        with self._cond:
+            self._buffer.clear()
+            self.acquired = 0
+            self.overruns = 0
+            self._acquiring = True
+        self._thread = threading.Thread(target = self._produce, name = "SimulatedCamera", daemon = True)
+        self._thread.start()
+
+    def stop_acquisition(self):
+        with self._cond:
+            self._acquiring = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _produce(self):
+        next_frame = time.monotonic()
+        while True:
+            next_frame += self.attributes['Exposure Time'] / 1000 + self.readout_time
+            with self._cond:
+                if self._cond.wait_for(lambda: not self._acquiring, max(next_frame - time.monotonic(), 0)):
+                    return
+            exposure = self.attributes['Exposure Time'] / 1000
+            img = self._bank[self.acquired % len(self._bank)] + np.uint16(self.dark_rate * exposure * 100)
+            with self._cond:
+                if len(self._buffer) >= self.buffer_frames:
+                    self._buffer.popleft()
+                    self.overruns += 1
+                self._buffer.append(img)
+                self.acquired += 1
+                self._cond.notify_all()
+
+    def wait_for_frame(self, since = 'lastread', nframes = 1, timeout = 20.0):
+        with self._cond:
+            if not self._acquiring and len(self._buffer) < nframes:
+                raise RuntimeError("Acquisition is not running")
+            if not self._cond.wait_for(lambda: len(self._buffer) >= nframes or not self._acquiring, timeout):
+                raise TimeoutError("Timed out waiting for a frame")
+
+    def read_oldest_image(self):
+        with self._cond:
+            return self._buffer.popleft() if self._buffer else None
+
+    def get_new_images_range(self):
+        # Indices (first, end) of the frames waiting in the buffer, end exclusive like pylablib
+        with self._cond:
+            if not self._buffer:
+                return None
+            return self.acquired - len(self._buffer), self.acquired
+
+    def read_multiple_images(self, rng = None, peek = False, missing_frame = 'skip', return_info = False):
+        with self._cond:
+            oldest = self.acquired - len(self._buffer)
+            begin, end = rng if rng is not None else (oldest, self.acquired)
+            begin, end = max(begin, oldest) - oldest, max(min(end, self.acquired) - oldest, 0)
+            images = list(self._buffer)[begin:end]
+            if not peek:
+                # Frames before the range are skipped, like frames read past in the driver
+                for _ in range(end):
+                    self._buffer.popleft()
+        return images
+
+    def get_frames_status(self):
+        with self._cond:
+            return self.acquired, len(self._buffer), self.overruns, self.buffer_frames
+
+    def close(self):
+        self.stop_acquisition()
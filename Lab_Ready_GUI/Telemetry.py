@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Background telemetry for the camera. A TelemetryPoller reads a list of camera
+attributes (sensor temperature and other status values) on its own thread at a
+configurable interval and caches every value with the time it was read. The GUI
+reads the cache instead of calling the driver, treats values older than a staleness
+limit as unknown, and is told about changed values through the on_change callback.
+on_read is called with every value read, changed or not, e.g. to feed a
+TemperatureMonitor that judges how long a reading has held.
+
+When polling starts, attributes the camera does not have (according to the
+`exists` check) are left out. A failed read of any other attribute is retried
+with an exponential backoff of up to MAXBACKOFF seconds, so a transient driver
+error does not stop an attribute from being polled for the rest of the session.
+"""
+
+import threading
+import time
+
+DEFAULTATTRIBUTES = ('Sensor Temperature Reading', 'Sensor Temperature Status', 'Exposure Time')
+# Longest wait (s) before retrying an attribute that failed to read
+MAXBACKOFF = 30.0
+
+
+class TelemetryPoller(object):
+    def __init__(self, read, attributes = DEFAULTATTRIBUTES, interval = 0.5, on_change = None,
+                 on_read = None, exists = None):
+        self.read = read
+        self.exists = exists
+        self.attributes = list(attributes)
+        self.interval = interval
+        self.on_change = on_change
+        self.on_read = on_read
+        self._values = {}
+        # name -> (consecutive failures, monotonic time of the next try)
+        self._retries = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._poll, name = "Telemetry", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _check_attributes(self):
+        # Not every camera has every attribute; stop asking for the missing ones
+        for name in list(self.attributes):
+            try:
+                present = self.exists(name)
+            except Exception as e:
+                print(f"Telemetry: cannot check '{name}', polling it anyway: {e}")
+                continue
+            if not present:
+                print(f"Telemetry: the camera has no '{name}'")
+                self.attributes.remove(name)
+
+    def _poll(self):
+        if self.exists is not None:
+            self._check_attributes()
+        while not self._stop.is_set():
+            for name in list(self.attributes):
+                failures, retry_at = self._retries.get(name, (0, 0.0))
+                if time.monotonic() < retry_at:
+                    continue
+                try:
+                    value = self.read(name)
+                except Exception as e:
+                    if failures == 0:
+                        print(f"Telemetry: cannot read '{name}', retrying: {e}")
+                    delay = min(self.interval * 2 ** failures, MAXBACKOFF)
+                    self._retries[name] = (failures + 1, time.monotonic() + delay)
+                    continue
+                if failures:
+                    print(f"Telemetry: '{name}' read again after {failures} failures")
+                    del self._retries[name]
+                self.update(name, value)
+            self._stop.wait(self.interval)
+
+    def update(self, name, value):
+        # Also used to feed values read elsewhere into the cache
+        with self._lock:
+            previous = self._values.get(name)
+            self._values[name] = (value, time.monotonic())
+        if self.on_read is not None:
+            self.on_read(name, value)
+        if self.on_change is not None and (previous is None or previous[0] != value):
+            self.on_change(name, value)
+
+    def get(self, name, max_age = None, default = None):
+        """Cached value of `name`, or `default` if it was never read or is older than `max_age` s."""
+        with self._lock:
+            entry = self._values.get(name)
+        if entry is None or (max_age is not None and time.monotonic() - entry[1] > max_age):
+            return default
+        return entry[0]
+
+    def age(self, name):
+        with self._lock:
+            entry = self._values.get(name)
+        return None if entry is None else time.monotonic() - entry[1]
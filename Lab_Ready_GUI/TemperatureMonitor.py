@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+Sensor temperature stabilization monitor. A TemperatureMonitor is fed every sensor
+temperature reading (by the telemetry poller, or by whoever waits on it) and keeps
+them in a preallocated history. The sensor counts as stable once its readings have
+stayed within `tolerance` of the set point for `dwell` seconds; `stable` is then a
+set threading.Event, so the acquisition can block on it instead of guessing delays.
+
+While the sensor is still cooling (or warming) towards the set point, eta() fits a
+Newton-like exponential approach, ln|reading - set point| against time, to the
+readings of the last `trend_window` seconds and estimates how long it takes to
+reach the tolerance band and hold there for the dwell time.
+
+Every listener is called with the new state ('unknown', 'approaching', 'drifting',
+'settling' or 'stable') whenever it changes, from the thread that fed the reading.
+"""
+
+import math
+import threading
+import time
+
+import numpy as np
+
+STATES = ('unknown', 'approaching', 'drifting', 'settling', 'stable')
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    return f"{minutes}:{seconds:02d}" if minutes else f"{seconds} s"
+
+
+class TemperatureMonitor(object):
+    def __init__(self, set_point = None, tolerance = 2.0, dwell = 30.0, history = 1200,
+                 trend_window = 60.0, on_change = None):
+        self.set_point = set_point
+        self.tolerance = tolerance
+        self.dwell = dwell
+        self.trend_window = trend_window
+        self.listeners = [on_change] if on_change is not None else []
+        self.state = 'unknown'
+        self.stable = threading.Event()
+        # (monotonic time, reading) rows, oldest overwritten first
+        self._history = np.full((history, 2), np.nan)
+        self._count = 0
+        # Time of the first reading of the current run of readings within tolerance
+        self._inside_since = None
+        self._lock = threading.Lock()
+
+    def watch(self, set_point, tolerance = None):
+        """Starts judging the readings against a new set point and tolerance."""
+        with self._lock:
+            if set_point == self.set_point and tolerance in (None, self.tolerance):
+                return
+            self.set_point = set_point
+            if tolerance is not None:
+                self.tolerance = tolerance
+            # The readings already taken may have been within the new tolerance for a while
+            self._inside_since = None
+            for when, reading in self._rows()[::-1]:
+                if abs(reading - set_point) > self.tolerance:
+                    break
+                self._inside_since = when
+        self._evaluate(time.monotonic())
+
+    def update(self, reading, now = None):
+        """Records a sensor reading, taken at monotonic time `now`."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._history[self._count % len(self._history)] = (now, reading)
+            self._count += 1
+            if self.set_point is not None and abs(reading - self.set_point) <= self.tolerance:
+                if self._inside_since is None:
+                    self._inside_since = now
+            else:
+                self._inside_since = None
+        self._evaluate(now)
+
+    def _evaluate(self, now):
+        with self._lock:
+            if self.set_point is None or self._count == 0:
+                state = 'unknown'
+            elif self._inside_since is None:
+                state = 'approaching' if self._rate() is not None else 'drifting'
+            elif now - self._inside_since >= self.dwell:
+                state = 'stable'
+            else:
+                state = 'settling'
+            changed = state != self.state
+            self.state = state
+        if state == 'stable':
+            self.stable.set()
+        else:
+            self.stable.clear()
+        if changed:
+            for listener in list(self.listeners):
+                listener(state)
+
+    def _rows(self):
+        n = min(self._count, len(self._history))
+        return self._history[np.arange(self._count - n, self._count) % len(self._history)]
+
+    def _rate(self):
+        # Decay rate (1/s) of the distance to the set point over the trend window, or
+        # None if the readings are not getting closer
+        rows = self._rows()
+        if len(rows) < 3:
+            return None
+        rows = rows[rows[:, 0] >= rows[-1, 0] - self.trend_window]
+        distance = np.abs(rows[:, 1] - self.set_point)
+        if len(rows) < 3 or rows[-1, 0] - rows[0, 0] <= 0 or np.any(distance <= 0):
+            return None
+        slope = np.polyfit(rows[:, 0] - rows[0, 0], np.log(distance), 1)[0]
+        return -slope if slope < 0 else None
+
+    def eta(self, now = None):
+        """Seconds until the sensor is expected to be stable, 0 if it is, None if unknown."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.set_point is None or self._count == 0:
+                return None
+            if self._inside_since is not None:
+                return max(self.dwell - (now - self._inside_since), 0.0)
+            rate = self._rate()
+            if rate is None:
+                return None
+            reading = self._history[(self._count - 1) % len(self._history), 1]
+            distance = abs(reading - self.set_point)
+            return math.log(distance / self.tolerance) / rate + self.dwell
+
+    def latest(self):
+        """(monotonic time, reading) of the newest reading, or None."""
+        with self._lock:
+            if self._count == 0:
+                return None
+            return tuple(self._history[(self._count - 1) % len(self._history)])
+
+    def age(self):
+        """Seconds since the newest reading, None if there is none."""
+        latest = self.latest()
+        return None if latest is None else time.monotonic() - latest[0]
+
+    def wait(self, timeout = None):
+        """Blocks until the sensor is stable; False if `timeout` s passed first."""
+        return self.stable.wait(timeout)
+
+    def history(self):
+        """Readings oldest first, as (n, 2) rows of (monotonic time, reading)."""
+        with self._lock:
+            return self._rows()
+
+    def describe(self):
+        if self.state == 'unknown':
+            return "Waiting for the sensor temperature"
+        if self.state == 'stable':
+            return f"Stable at {self.set_point:g} °C"
+        eta = self.eta()
+        if self.state == 'settling':
+            return f"Within ±{self.tolerance:g} °C of {self.set_point:g} °C, stable in {_duration(eta)}"
+        reading = self.latest()[1]
+        direction = "Cooling" if reading > self.set_point else "Warming"
+        if eta is None:
+            return f"{direction} to {self.set_point:g} °C, at {reading:g} °C"
+        return f"{direction} to {self.set_point:g} °C, at {reading:g} °C, stable in about {_duration(eta)}"
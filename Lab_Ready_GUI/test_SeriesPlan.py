@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from SeriesPlan import SeriesError, compile_series
+
+
+@pytest.mark.parametrize('text', [
+    "1 nan a",
+    "1 inf a",
+    "add delay inf",
+    "add delay nan",
+    "add delay 1e12",
+    "1 1..10:nan a",
+    "1 nan..10:1 a",
+    "1 10,nan a",
+    "wait temperature nan",
+    "wait temperature -70 ±nan",
+])
+def test_rejects_non_finite_and_out_of_range_numbers(text):
+    with pytest.raises(SeriesError):
+        compile_series(text)
+
+
+def test_summary_of_valid_series():
+    plan = compile_series("wait temperature -70 ±0.5\n2 1..3:1 d_$exposure\nadd delay 100")
+    assert len(plan) == 5
+    assert plan.summary()